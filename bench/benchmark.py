@@ -0,0 +1,383 @@
+"""
+端到端 benchmark：在單一 process 內跑 controller（FastAPI TestClient）與 worker 的處理流程
+- 自動產生合成的 ZIP 圖片與 PDF 語料（固定 seed，可重現）
+- Redis 使用 fakeredis，或以 --redis-url 指向本機 Redis（會清空該 db）
+- 外部服務與模型換成 bench/stubs.py 的本地替身
+量測 ingest images/sec、不同 library 大小下的 search p50/p99、SSE 每次推送的成本，
+結果寫成 JSON 報告；指定 --baseline 時與舊報告比較，退步超過 --tolerance 則 exit 1
+
+用法：
+    python bench/benchmark.py --images 200 --pdf-pages 10 --library-sizes 1000,10000 --output bench_report.json
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+
+import numpy as np
+from PIL import Image
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import stubs
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Image RAG end-to-end benchmark")
+    parser.add_argument("--images", type=int, default=200, help="ZIP 語料中的圖片數")
+    parser.add_argument("--image-size", default="1600x1200", help="合成圖片尺寸 WxH")
+    parser.add_argument("--pdf-pages", type=int, default=10, help="PDF 語料頁數，0 表示略過")
+    parser.add_argument("--library-sizes", default="1000,10000", help="search 測試的 library 大小（逗號分隔）")
+    parser.add_argument("--queries", type=int, default=200, help="每個 library 大小的查詢次數")
+    parser.add_argument("--sse-clients", default="1,10,100", help="SSE 同時連線數（逗號分隔）")
+    parser.add_argument("--redis-url", default=None, help="使用真正的 Redis（例如 redis://localhost:6379/15），預設 fakeredis")
+    parser.add_argument("--real-models", action="store_true", help="使用真正的 BLIP / SentenceTransformer")
+    parser.add_argument("--model-latency", default="", help="替身模型的模擬延遲，例如 blip=0.2,embed=0.005,cohere=0.1")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--output", default="bench_report.json")
+    parser.add_argument("--baseline", default=None, help="與之前的報告比較")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="允許的退步比例")
+    parser.add_argument("--verbose", action="store_true", help="顯示 controller / worker 的 log")
+    return parser.parse_args()
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    return float(np.percentile(np.asarray(values), p))
+
+
+def latency_summary(seconds):
+    ms = [s * 1000 for s in seconds]
+    return {
+        "n": len(ms),
+        "p50_ms": percentile(ms, 50),
+        "p95_ms": percentile(ms, 95),
+        "p99_ms": percentile(ms, 99),
+        "mean_ms": float(np.mean(ms)) if ms else None,
+    }
+
+
+# ===== 語料產生 =====
+def synthetic_image(rng, width, height):
+    """漸層 + 色塊 + 雜訊，JPEG 壓縮後的大小與解碼成本接近真實照片"""
+    x = np.linspace(0, 1, width, dtype=np.float32)
+    y = np.linspace(0, 1, height, dtype=np.float32)[:, None]
+    base = rng.uniform(0, 255, size=3)
+    tilt = rng.uniform(-120, 120, size=3)
+    img = base + tilt * (x[None, :, None] * 0.6 + y[:, :, None] * 0.4)
+    for _ in range(4):
+        x0, y0 = rng.integers(0, width // 2), rng.integers(0, height // 2)
+        img[y0:y0 + height // 3, x0:x0 + width // 3] += rng.uniform(-80, 80, size=3)
+    img += rng.normal(0, 12, size=img.shape)
+    return Image.fromarray(np.clip(img, 0, 255).astype(np.uint8), "RGB")
+
+
+def make_zip_corpus(n, size, seed):
+    rng = np.random.default_rng(seed)
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_STORED) as zf:
+        for i in range(n):
+            img_buf = io.BytesIO()
+            synthetic_image(rng, *size).save(img_buf, "JPEG", quality=90)
+            zf.writestr(f"bench/img_{i:05}.jpg", img_buf.getvalue())
+    return buf.getvalue()
+
+
+def make_pdf_corpus(pages, seed):
+    rng = np.random.default_rng(seed + 1)
+    imgs = [synthetic_image(rng, 1240, 1754) for _ in range(pages)]  # A4 @150dpi
+    buf = io.BytesIO()
+    imgs[0].save(buf, "PDF", save_all=True, append_images=imgs[1:], resolution=150)
+    return buf.getvalue()
+
+
+# ===== 環境設定 =====
+def setup(args, data_dir):
+    os.environ["DATA_DIR"] = data_dir
+    os.environ.setdefault("JWT_SECRET", "bench-secret")
+
+    latency = {}
+    for part in filter(None, args.model_latency.split(",")):
+        k, v = part.split("=")
+        latency[k.strip()] = float(v)
+    stubs.install(real_models=args.real_models, latency=latency)
+
+    sys.path.insert(0, ROOT)  # common/
+    sys.path.insert(0, os.path.join(ROOT, "controller"))
+    sys.path.insert(0, os.path.join(ROOT, "worker"))
+    import main
+    import worker
+    from common import context
+
+    if args.redis_url:
+        from redis import Redis
+        client = Redis.from_url(args.redis_url, decode_responses=True)
+        client.flushdb()
+    else:
+        import fakeredis
+        client = fakeredis.FakeRedis(server=fakeredis.FakeServer(), decode_responses=True)
+    main.redis = client
+    worker.redis = client
+    context.configure(client, "bench")
+
+    worker.load_models()
+    return main, worker
+
+
+def drain_worker(worker):
+    """在目前 process 內把佇列跑完，回傳處理的任務數（含失敗的任務，成功數請看 counter_total）"""
+    done = 0
+    while True:
+        task = worker.claim_task()
+        if task is None:
+            break
+        worker.process_task(*task)
+        done += 1
+    return done
+
+
+def counter_total(redis, name, **labels):
+    """加總 metrics:counter:{name} 中帶有指定 labels 的 series"""
+    want = {f'{k}="{v}"' for k, v in labels.items()}
+    return int(sum(
+        float(value) for lbl, value in redis.hgetall(f"metrics:counter:{name}").items()
+        if want <= set(lbl.split(","))
+    ))
+
+
+def stage_breakdown(redis):
+    """從 Redis 上的 stage_seconds histogram 取出每個階段的平均耗時"""
+    raw = redis.hgetall("metrics:hist:stage_seconds")
+    stages = {}
+    for field, value in raw.items():
+        lbl, part = field.rsplit("|", 1)
+        if part not in ("sum", "count"):
+            continue
+        stage = lbl.split('stage="', 1)[1].split('"', 1)[0]
+        stages.setdefault(stage, {"sum": 0.0, "count": 0})
+        stages[stage][part] += float(value)
+    return {
+        k: {"count": int(v["count"]), "mean_ms": v["sum"] / v["count"] * 1000 if v["count"] else None}
+        for k, v in sorted(stages.items())
+    }
+
+
+# ===== Benchmarks =====
+def bench_ingest(main, worker, client, headers, args):
+    size = tuple(int(x) for x in args.image_size.split("x"))
+    corpus = make_zip_corpus(args.images, size, args.seed)
+    result = {"images": args.images, "zip_bytes": len(corpus)}
+
+    t0 = time.perf_counter()
+    resp = client.post("/upload", files={"zip_file": ("bench.zip", corpus, "application/zip")}, headers=headers)
+    resp.raise_for_status()
+    result["upload_seconds"] = time.perf_counter() - t0
+
+    # 只算成功寫進 index 的張數，失敗的任務不能灌高吞吐量
+    t0 = time.perf_counter()
+    result["tasks"] = drain_worker(worker)
+    elapsed = time.perf_counter() - t0
+    processed = counter_total(main.redis, "images_processed_total", kind="image")
+    result["processed"] = processed
+    result["process_seconds"] = elapsed
+    result["images_per_sec"] = processed / elapsed if elapsed else None
+
+    if args.pdf_pages:
+        pdf = make_pdf_corpus(args.pdf_pages, args.seed)
+        t0 = time.perf_counter()
+        resp = client.post("/upload/pdf", files={"upload_file": ("bench.pdf", pdf, "application/pdf")}, headers=headers)
+        if resp.status_code == 200:
+            upload = time.perf_counter() - t0
+            t0 = time.perf_counter()
+            tasks = drain_worker(worker)
+            elapsed = time.perf_counter() - t0
+            pages = counter_total(main.redis, "images_processed_total", kind="pdf")
+            result["pdf"] = {
+                "tasks": tasks,
+                "pages": pages,
+                "upload_seconds": upload,
+                "process_seconds": elapsed,
+                "pages_per_sec": pages / elapsed if elapsed else None,
+            }
+        else:
+            result["pdf"] = {"skipped": resp.text}
+    result["errors"] = counter_total(main.redis, "task_errors_total")
+    return result
+
+
+def ingest_failures(ingest, args):
+    """張數對不上或有任務出錯時，這次的吞吐量不可信"""
+    failures = []
+    if ingest["processed"] != args.images:
+        failures.append(f"processed {ingest['processed']} of {args.images} images")
+    if "pages" in ingest.get("pdf", {}) and ingest["pdf"]["pages"] != args.pdf_pages:
+        failures.append(f"processed {ingest['pdf']['pages']} of {args.pdf_pages} PDF pages")
+    if ingest["errors"]:
+        failures.append(f"{ingest['errors']} task errors")
+    return failures
+
+
+def bench_search(main, client, sizes, queries, seed):
+    rng = random.Random(seed)
+    results = []
+    for size in sizes:
+        user = f"bench_lib_{size}"
+        metadata = []
+        for i in range(size):
+            color = rng.choice(stubs.COLOR_WORDS)
+            scene = rng.choice(stubs.SCENE_WORDS)
+            metadata.append({"filename": f"uploads/{user}/img_{i:06}.jpg", "caption": f"a {color} photo of a {scene}"})
+
+        t0 = time.perf_counter()
+        params = main.index_params({})
+        vecs = main.encode_entries(metadata, params)
+        index = main.build_index(vecs.shape[1], params)
+        index.add(vecs)
+        main.commit_snapshot(user, "image", index, metadata, {"version": 0, "seq": 0, "ntotal": 0})
+        build = time.perf_counter() - t0
+
+        headers = {"Authorization": f"Bearer {main.create_access_token({'sub': user})}"}
+        timings = []
+        for _ in range(queries):
+            q = f"{rng.choice(stubs.COLOR_WORDS)} {rng.choice(stubs.SCENE_WORDS)}"
+            t0 = time.perf_counter()
+            resp = client.post("/search?top_k=5", data={"query": q}, headers=headers)
+            timings.append(time.perf_counter() - t0)
+            resp.raise_for_status()
+        results.append({"library_size": size, "build_seconds": build, **latency_summary(timings)})
+    return results
+
+
+def bench_sse(main, user, client_counts):
+    """量測每個 SSE 連線產生一次推送資料的成本（不含兩次推送之間的 sleep）"""
+    async def run(n):
+        responses = [await main.status_sse(user=user) for _ in range(n)]
+        gens = [r.body_iterator for r in responses]
+        t0 = time.perf_counter()
+        for g in gens:
+            await g.__anext__()
+        elapsed = time.perf_counter() - t0
+        for g in gens:
+            await g.aclose()
+        return elapsed
+
+    results = []
+    for n in client_counts:
+        elapsed = asyncio.run(run(n))
+        results.append({"clients": n, "tick_ms": elapsed * 1000, "per_client_ms": elapsed * 1000 / n})
+    return results
+
+
+# ===== 報告比較 =====
+def compare(report, baseline, tolerance):
+    """回傳退步項目清單；吞吐量越低越差，延遲越高越差"""
+    regressions = []
+
+    def check(name, new, old, higher_is_better):
+        if new is None or old is None or old == 0:
+            return
+        change = (new - old) / old
+        worse = -change if higher_is_better else change
+        if worse > tolerance:
+            regressions.append({"metric": name, "baseline": old, "current": new, "change": round(change, 4)})
+
+    check("ingest.images_per_sec", report["ingest"].get("images_per_sec"), baseline["ingest"].get("images_per_sec"), True)
+    old_search = {r["library_size"]: r for r in baseline.get("search", [])}
+    for r in report["search"]:
+        old = old_search.get(r["library_size"])
+        if old:
+            check(f"search[{r['library_size']}].p50_ms", r["p50_ms"], old["p50_ms"], False)
+            check(f"search[{r['library_size']}].p99_ms", r["p99_ms"], old["p99_ms"], False)
+    old_sse = {r["clients"]: r for r in baseline.get("sse", [])}
+    for r in report["sse"]:
+        old = old_sse.get(r["clients"])
+        if old:
+            check(f"sse[{r['clients']}].per_client_ms", r["per_client_ms"], old["per_client_ms"], False)
+    return regressions
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT, text=True).strip()
+    except Exception:
+        return None
+
+
+def main_entry():
+    args = parse_args()
+    with tempfile.TemporaryDirectory(prefix="image-rag-bench-") as data_dir:
+        quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+        with quiet:
+            main, worker = setup(args, data_dir)
+            from fastapi.testclient import TestClient
+            client = TestClient(main.app)  # 不進入 lifespan，monitor_loop 不會啟動
+
+            user = "bench_user"
+            client.post("/signup", json={"username": user, "password": "bench"}).raise_for_status()
+            headers = {"Authorization": f"Bearer {main.create_access_token({'sub': user})}"}
+
+            ingest = bench_ingest(main, worker, client, headers, args)
+            ingest["stages"] = stage_breakdown(main.redis)
+            search = bench_search(
+                main, client,
+                [int(x) for x in args.library_sizes.split(",") if x],
+                args.queries, args.seed,
+            )
+            sse = bench_sse(main, user, [int(x) for x in args.sse_clients.split(",") if x])
+
+    report = {
+        "meta": {
+            "ts": time.time(),
+            "git": git_revision(),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "redis": args.redis_url or "fakeredis",
+            "real_models": args.real_models,
+            "model_latency": args.model_latency,
+            "seed": args.seed,
+        },
+        "ingest": ingest,
+        "search": search,
+        "sse": sse,
+    }
+
+    exit_code = 0
+    report["failures"] = ingest_failures(ingest, args)
+    if report["failures"]:
+        exit_code = 1
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            report["regressions"] = compare(report, json.load(f), args.tolerance)
+        if report["regressions"]:
+            exit_code = 1
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+
+    print(f"ingest: {ingest['images_per_sec']:.2f} images/sec ({ingest['processed']} images)")
+    for r in search:
+        print(f"search[{r['library_size']}]: p50={r['p50_ms']:.2f}ms p99={r['p99_ms']:.2f}ms")
+    for r in sse:
+        print(f"sse[{r['clients']} clients]: {r['per_client_ms']:.3f}ms per client per tick")
+    for f in report["failures"]:
+        print(f"❌ ingest failed: {f}")
+    for r in report.get("regressions", []):
+        print(f"❌ regression {r['metric']}: {r['baseline']} -> {r['current']} ({r['change']:+.1%})")
+    print(f"report written to {args.output}")
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main_entry())
@@ -0,0 +1,162 @@
+"""
+Benchmark 用的本地替身：在 import controller / worker 之前放進 sys.modules
+- 外部服務（Cohere、Gemini、Nominatim）一律換成 deterministic 的本地實作
+- BLIP / SentenceTransformer 預設也換掉，--real-models 時保留真正的模型
+所有輸出都只由輸入決定，同一份語料每次跑出來的 caption 與向量都相同
+"""
+import sys
+import time
+import types
+import hashlib
+
+import numpy as np
+
+# 模擬模型推論耗時（秒），讓吞吐量數字接近真實比例
+MODEL_LATENCY = {"blip": 0.0, "embed": 0.0, "cohere": 0.0, "gemini": 0.0}
+
+EMBED_DIM = 384
+COHERE_DIM = 1536
+
+COLOR_WORDS = ["red", "orange", "yellow", "green", "blue", "purple", "gray", "white"]
+SCENE_WORDS = ["beach", "mountain", "city street", "forest", "kitchen", "park", "river", "room"]
+
+
+def _stable_hash(text):
+    return int(hashlib.md5(text.encode("utf-8")).hexdigest()[:8], 16)
+
+
+def hashed_embedding(text, dim):
+    """bag-of-words hashing：相同詞彙的句子向量相近，搜尋結果有意義"""
+    vec = np.zeros(dim, dtype=np.float32)
+    for token in text.lower().replace(".", " ").replace(",", " ").split():
+        h = _stable_hash(token)
+        vec[h % dim] += 1.0 if (h >> 16) & 1 else -1.0
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm else vec
+
+
+# ===== transformers =====
+class _Inputs(dict):
+    def to(self, device):
+        return self
+
+
+class StubBlipProcessor:
+    @classmethod
+    def from_pretrained(cls, name):
+        return cls()
+
+    def __call__(self, image, return_tensors="pt"):
+        return _Inputs(pixel_values=image)
+
+    def decode(self, out, skip_special_tokens=True):
+        return out
+
+
+class StubBlipModel:
+    @classmethod
+    def from_pretrained(cls, name):
+        return cls()
+
+    def to(self, device):
+        return self
+
+    def generate(self, pixel_values=None, max_length=50, **kwargs):
+        if MODEL_LATENCY["blip"]:
+            time.sleep(MODEL_LATENCY["blip"])
+        small = np.asarray(pixel_values.resize((8, 8)), dtype=np.float32)
+        r, g, b = small.reshape(-1, 3).mean(axis=0)
+        color = COLOR_WORDS[int(r + 2 * g + 3 * b) % len(COLOR_WORDS)]
+        scene = SCENE_WORDS[int(small.std()) % len(SCENE_WORDS)]
+        return [f"a {color} photo of a {scene}"]
+
+
+# ===== sentence_transformers =====
+class StubSentenceTransformer:
+    def __init__(self, name, *args, **kwargs):
+        self.name = name
+
+    def get_sentence_embedding_dimension(self):
+        return EMBED_DIM
+
+    def encode(self, sentences, batch_size=32, convert_to_numpy=True, **kwargs):
+        single = isinstance(sentences, str)
+        items = [sentences] if single else list(sentences)
+        if MODEL_LATENCY["embed"]:
+            time.sleep(MODEL_LATENCY["embed"] * len(items))
+        vecs = np.stack([hashed_embedding(t, EMBED_DIM) for t in items]) if items else np.zeros((0, EMBED_DIM), np.float32)
+        return vecs[0] if single else vecs
+
+
+# ===== cohere =====
+class StubCohereClient:
+    def __init__(self, api_key=None, **kwargs):
+        pass
+
+    def embed(self, model, inputs, input_type, embedding_types):
+        if MODEL_LATENCY["cohere"]:
+            time.sleep(MODEL_LATENCY["cohere"])
+        vectors = []
+        for item in inputs:
+            content = item["content"][0]
+            key = content.get("text") or content["image_url"]["url"][-256:]
+            vectors.append(hashed_embedding(key, COHERE_DIM).tolist())
+        embeddings = types.SimpleNamespace(float_=vectors)
+        return types.SimpleNamespace(embeddings=embeddings)
+
+
+# ===== google.generativeai =====
+class StubGenerativeModel:
+    def __init__(self, name):
+        self.name = name
+
+    def generate_content(self, prompt):
+        if MODEL_LATENCY["gemini"]:
+            time.sleep(MODEL_LATENCY["gemini"])
+        return types.SimpleNamespace(text="This page is a synthetic benchmark page.")
+
+
+# ===== geopy =====
+class StubNominatim:
+    def __init__(self, user_agent=None, **kwargs):
+        pass
+
+    def reverse(self, point, language="en", timeout=10):
+        lat, lon = point
+        return types.SimpleNamespace(raw={"address": {"country": "Benchland", "city": f"City {int(lat) % 10}-{int(lon) % 10}"}})
+
+
+def _module(name, **attrs):
+    mod = types.ModuleType(name)
+    mod.__dict__.update(attrs)
+    return mod
+
+
+def install(real_models=False, latency=None):
+    """把替身模組放進 sys.modules，必須在 import main / worker 之前呼叫"""
+    if latency:
+        MODEL_LATENCY.update(latency)
+
+    sys.modules["cohere"] = _module("cohere", ClientV2=StubCohereClient)
+    genai = _module("google.generativeai", GenerativeModel=StubGenerativeModel, configure=lambda api_key=None: None)
+    try:
+        import google  # 可能是 protobuf 等套件共用的 namespace package，不能直接覆蓋
+    except ImportError:
+        google = _module("google")
+        google.__path__ = []
+        sys.modules["google"] = google
+    google.generativeai = genai
+    sys.modules["google.generativeai"] = genai
+    sys.modules["geopy"] = _module("geopy")
+    sys.modules["geopy.geocoders"] = _module("geopy.geocoders", Nominatim=StubNominatim)
+
+    if not real_models:
+        sys.modules["transformers"] = _module(
+            "transformers",
+            BlipProcessor=StubBlipProcessor,
+            BlipForConditionalGeneration=StubBlipModel,
+        )
+        sys.modules["sentence_transformers"] = _module(
+            "sentence_transformers",
+            SentenceTransformer=StubSentenceTransformer,
+        )
@@ -0,0 +1 @@
+"""controller 與 worker 共用的程式碼：index snapshot 協定、metrics、分片配置，兩個 image 都會複製這個目錄"""
@@ -0,0 +1,9 @@
+"""共用模組的執行環境：各服務啟動（或 fork 出子行程）時以 configure() 設定 Redis 連線與服務名稱"""
+
+redis = None
+service_name = "unknown"
+
+def configure(redis_client, service):
+    global redis, service_name
+    redis = redis_client
+    service_name = service
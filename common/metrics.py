@@ -0,0 +1,67 @@
+"""Metrics：histogram / counter / gauge 都累加在 Redis，controller 的 /metrics 統一輸出"""
+import re
+import time
+from contextlib import contextmanager
+
+from common import context
+
+METRICS_PREFIX = "metrics"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+# bulk 的排隊時間可能到數小時：在 LATENCY_BUCKETS 之後延伸，舊資料的格子仍然對得上
+QUEUE_WAIT_BUCKETS = LATENCY_BUCKETS + (600, 1800, 3600, 7200, 14400, 28800, 86400)
+HISTOGRAM_BUCKETS = {"queue_wait_seconds": QUEUE_WAIT_BUCKETS}
+
+def histogram_buckets(name):
+    return HISTOGRAM_BUCKETS.get(name, LATENCY_BUCKETS)
+
+def escape_label_value(value):
+    """Prometheus text format 的 label 值需跳脫反斜線、雙引號與換行"""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+# 解析 metric_labels 產生的字串；值裡可能有逗號、等號或跳脫過的雙引號
+METRIC_LABEL_RE = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+def metric_labels(labels):
+    return ",".join(f'{k}="{escape_label_value(v)}"' for k, v in sorted(labels.items()))
+
+def observe(name, seconds, **labels):
+    """記錄一次耗時；bucket 只加在第一個 >= 值的格子，輸出時再累計成 Prometheus 的 le 格式"""
+    lbl = metric_labels(labels)
+    bucket = next((b for b in histogram_buckets(name) if seconds <= b), "+Inf")
+    key = f"{METRICS_PREFIX}:hist:{name}"
+    try:
+        pipe = context.redis.pipeline(transaction=False)
+        pipe.sadd(f"{METRICS_PREFIX}:hist_names", name)
+        pipe.hincrby(key, f"{lbl}|{bucket}", 1)
+        pipe.hincrbyfloat(key, f"{lbl}|sum", seconds)
+        pipe.hincrby(key, f"{lbl}|count", 1)
+        pipe.execute()
+    except Exception as e:
+        print(f"⚠️ Failed to record metric {name}: {e}")
+
+def inc_counter(name, amount=1, **labels):
+    try:
+        pipe = context.redis.pipeline(transaction=False)
+        pipe.sadd(f"{METRICS_PREFIX}:counter_names", name)
+        pipe.hincrbyfloat(f"{METRICS_PREFIX}:counter:{name}", metric_labels(labels), amount)
+        pipe.execute()
+    except Exception as e:
+        print(f"⚠️ Failed to record metric {name}: {e}")
+
+def set_gauge(name, value, **labels):
+    try:
+        pipe = context.redis.pipeline(transaction=False)
+        pipe.sadd(f"{METRICS_PREFIX}:gauge_names", name)
+        pipe.hset(f"{METRICS_PREFIX}:gauge:{name}", metric_labels(labels), value)
+        pipe.execute()
+    except Exception as e:
+        print(f"⚠️ Failed to record metric {name}: {e}")
+
+@contextmanager
+def timed(stage, **labels):
+    """with timed("blip"): ... 記錄該階段耗時到 stage_seconds"""
+    t0 = time.time()
+    try:
+        yield
+    finally:
+        observe("stage_seconds", time.time() - t0, stage=stage, service=context.service_name, **labels)
@@ -0,0 +1,66 @@
+"""
+分片儲存：使用者依 consistent hashing 分配到 DATA_ROOTS 其中一個 root
+每個 root 底下維持原本的配置（uploads/{user}/、derivatives/、index 檔），任務路徑都是相對於該 root
+"""
+import bisect
+import hashlib
+import os
+
+from common import context
+
+DATA_DIR = os.getenv("DATA_DIR", "/data")
+DATA_ROOTS = [r.strip() for r in os.getenv("DATA_ROOTS", DATA_DIR).split(",") if r.strip()]
+SHARD_VNODES = 64
+USER_SHARD_HASH = "user_shard"
+MIGRATING_PREFIX = "migrating"
+# 已掛載的 root 底下的標記檔：沒掛載時路徑只是容器內的空目錄，寫進去的資料重啟就消失
+ROOT_MARKER = ".data_root"
+
+def ring_hash(key):
+    return int(hashlib.md5(key.encode("utf-8")).hexdigest()[:16], 16)
+
+# 每個 root 在 ring 上放 SHARD_VNODES 個虛擬節點，新增 root 時只有約 1/N 的使用者需要搬移
+SHARD_RING = sorted((ring_hash(f"{root}#{i}"), root) for root in DATA_ROOTS for i in range(SHARD_VNODES))
+SHARD_RING_KEYS = [h for h, _ in SHARD_RING]
+
+def ring_shard(user, roots=None):
+    """hash ring 上順時針第一個屬於 roots 的 root（預設為全部 DATA_ROOTS），都不在時回傳 None"""
+    i = bisect.bisect(SHARD_RING_KEYS, ring_hash(user))
+    for k in range(len(SHARD_RING)):
+        root = SHARD_RING[(i + k) % len(SHARD_RING)][1]
+        if roots is None or root in roots:
+            return root
+    return None
+
+def root_available(root):
+    """
+    root 是否已掛載、可以寫入：以 ROOT_MARKER 判斷，第一次看到掛載點時自動建立
+    不是掛載點的目錄要當 root 用時需手動建立 marker；只有一個 root 時沒有其他選擇，一律可用
+    """
+    if len(DATA_ROOTS) == 1:
+        return True
+    marker = os.path.join(root, ROOT_MARKER)
+    if os.path.exists(marker):
+        return True
+    if not os.path.ismount(root):
+        return False
+    try:
+        open(marker, "a").close()
+    except OSError:
+        return False
+    return True
+
+def user_root(user):
+    """使用者資料所在的 root：以 Redis 上的配置為準，搬移完成時才會切換"""
+    root = context.redis.hget(USER_SHARD_HASH, user)
+    if root:
+        return root
+    # 尚未記錄配置：已有資料的舊使用者留在原本的 root（之後由 rebalance 搬移），
+    # 新使用者依 hash ring；hash 到的 root 沒掛載時先放在 ring 上下一個已掛載的 root，掛載後再由 rebalance 搬回
+    mounted = [r for r in DATA_ROOTS if root_available(r)]
+    if not mounted:
+        raise RuntimeError(f"None of the data roots {', '.join(DATA_ROOTS)} is mounted")
+    root = (next((r for r in mounted if os.path.isdir(os.path.join(r, "uploads", user))), None)
+            or ring_shard(user, mounted))
+    context.redis.hsetnx(USER_SHARD_HASH, user, root)
+    return context.redis.hget(USER_SHARD_HASH, user)
@@ -0,0 +1,365 @@
+"""
+Index snapshot 持久化（controller 與 worker 必須使用同一份實作）
+manifest 是 snapshot 的 commit point，記錄目前版本的 index / metadata 檔名、向量數與已併入的 log 序號
+ingest：持寫入鎖 append 一行到 log（fsync 後即 durable），不重寫 snapshot
+checkpoint：log 累積 SNAPSHOT_CHECKPOINT_ENTRIES 筆或距上一版超過 SNAPSHOT_CHECKPOINT_SECONDS 秒時，
+           寫新版本 index、metadata（暫存檔 + fsync + rename）→ 原子替換 manifest → 清空 log、刪除更舊的版本
+讀取端 = manifest 指向的 snapshot + 重播 log 尾端，不需要持有寫入鎖
+"""
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import faiss
+import numpy as np
+from redis.exceptions import LockError
+
+from common import context
+from common.metrics import observe, set_gauge
+from common.shards import user_root
+
+EMBED_MODEL = os.getenv("EMBED_MODEL", "all-MiniLM-L6-v2")
+# /reindex 可以切換的模型（逗號分隔）；controller 與 worker 啟動時全部預先載入，不接受清單外的模型
+EMBED_MODELS = list(dict.fromkeys(
+    [EMBED_MODEL] + [m.strip() for m in os.getenv("EMBED_MODELS", "").split(",") if m.strip()]
+))
+
+SNAPSHOT_KINDS = {
+    "image": {"index": "index_file", "meta": "metadata", "manifest": "manifest", "log": "ingest_log"},
+    "pdf":   {"index": "pdf_index", "meta": "pdf_metadata", "manifest": "pdf_manifest", "log": "pdf_ingest_log"},
+}
+
+# 寫入鎖的 TTL：checkpoint 會重寫整份 index 與 metadata，要涵蓋大型 index 的寫檔時間；
+# commit_snapshot 寫檔前與切換 manifest 前都會再延長一次
+SNAPSHOT_LOCK_TIMEOUT = 120
+SNAPSHOT_READ_RETRIES = 3
+SNAPSHOT_CHECKPOINT_ENTRIES = int(os.getenv("SNAPSHOT_CHECKPOINT_ENTRIES", "200"))
+SNAPSHOT_CHECKPOINT_SECONDS = float(os.getenv("SNAPSHOT_CHECKPOINT_SECONDS", "60"))
+LOG_TAIL_CHUNK = 64 * 1024
+# 查詢端在記憶體中保留幾份 (user, kind) 的 snapshot
+SNAPSHOT_CACHE_SIZE = int(os.getenv("SNAPSHOT_CACHE_SIZE", "32"))
+
+class SnapshotConflict(Exception):
+    """寫入鎖已過期或 manifest 已被其他 writer 更新，這次 commit 作廢，需重新讀取後再寫"""
+
+# index 的 embedding 模型、類型與距離記錄在 manifest，reindex 時才會改變；沒有記錄的舊 manifest 用預設值
+INDEX_PARAM_KEYS = ("embed_model", "index_type", "metric")
+INDEX_TYPES = ("flat", "hnsw")
+INDEX_METRICS = {"l2": faiss.METRIC_L2, "ip": faiss.METRIC_INNER_PRODUCT}
+HNSW_M = 32
+
+def index_params(manifest):
+    return {
+        "embed_model": manifest.get("embed_model", EMBED_MODEL),
+        "index_type": manifest.get("index_type", "flat"),
+        "metric": manifest.get("metric", "l2"),
+    }
+
+def build_index(dim, params):
+    metric = INDEX_METRICS[params["metric"]]
+    if params["index_type"] == "hnsw":
+        return faiss.IndexHNSWFlat(dim, HNSW_M, metric)
+    return faiss.IndexFlat(dim, metric)
+
+def snapshot_files(user, kind, root=None):
+    names = SNAPSHOT_KINDS[kind]
+    root = root or user_root(user)
+    return {
+        "root": root,
+        "manifest": os.path.join(root, f"{names['manifest']}_{user}.json"),
+        "log": os.path.join(root, f"{names['log']}_{user}.jsonl"),
+        # 舊版直接覆寫的檔案，第一次 commit 後移除
+        "legacy_index": os.path.join(root, f"{names['index']}_{user}.index"),
+        "legacy_meta": os.path.join(root, f"{names['meta']}_{user}.json"),
+    }
+
+def atomic_write_bytes(path, data):
+    tmp_path = f"{path}.tmp-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    # rename 也要 fsync 目錄才算真正落盤
+    dir_fd = os.open(os.path.dirname(path), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+def read_manifest(user, kind, root=None):
+    path = snapshot_files(user, kind, root)["manifest"]
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def load_snapshot(user, kind, replay=False):
+    """
+    讀取 manifest 指向的 index 與 metadata，回傳 (index, metadata, manifest)
+    - 尚無任何資料時 index 為 None
+    - 沒有 manifest 時沿用舊格式檔案，並截到兩邊一致的長度
+    - replay=True（寫入端）會重播 manifest 之後才寫進 log 的項目，manifest["seq"] 隨之更新
+    查詢端請用 cached_snapshot，不要每次都讀整份檔案
+    """
+    files = snapshot_files(user, kind)
+
+    # 讀 manifest 與開檔之間若連續發生兩次 commit，舊版本檔案已被刪除：重讀 manifest 再試
+    for attempt in range(SNAPSHOT_READ_RETRIES):
+        manifest = read_manifest(user, kind, files["root"])
+        if not manifest:
+            break
+        try:
+            index = faiss.read_index(os.path.join(files["root"], manifest["index"]))
+            with open(os.path.join(files["root"], manifest["metadata"]), "r", encoding="utf-8") as f:
+                metadata = json.load(f)
+            break
+        except (FileNotFoundError, RuntimeError):
+            # faiss 找不到檔案時丟 RuntimeError
+            if attempt == SNAPSHOT_READ_RETRIES - 1:
+                raise
+            time.sleep(0.01)
+
+    if not manifest:
+        manifest = {"version": 0, "seq": 0, "ntotal": 0}
+        index = None
+        metadata = []
+        if os.path.exists(files["legacy_meta"]):
+            with open(files["legacy_meta"], "r", encoding="utf-8") as f:
+                metadata = json.load(f)
+        if os.path.exists(files["legacy_index"]):
+            index = faiss.read_index(files["legacy_index"])
+            n = min(index.ntotal, len(metadata))
+            if index.ntotal > n:
+                index.remove_ids(faiss.IDSelectorRange(n, index.ntotal))
+            metadata = metadata[:n]
+        else:
+            metadata = []
+
+    if replay:
+        index, manifest, _, _ = replay_log(files["log"], index, metadata, manifest)
+
+    return index, metadata, manifest
+
+def replay_log(path, index, metadata, manifest, offset=0, live=None):
+    """
+    從 offset（byte）起重播 log 中 seq 大於 manifest["seq"] 的紀錄，新增到 index 與 metadata（原地修改）
+    回傳 (index, manifest, offset, live)，offset 停在最後一行完整紀錄之後，下次可從這裡接著讀
+    - 同一個檔案的有效項目只保留一筆：崩潰前 append 過的任務在租約到期後會被重新派發、再 append 一次
+    - live 為目前有效項目的檔名集合，None 時由 metadata 建立
+    """
+    if not os.path.exists(path):
+        return index, manifest, offset, live
+    seq = manifest["seq"]
+    with open(path, "rb") as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b"\n"):
+                break  # writer 還沒寫完（或崩潰時寫到一半）的最後一行
+            try:
+                rec = json.loads(line)
+            except json.JSONDecodeError:
+                break
+            offset += len(line)
+            if rec["seq"] <= seq:
+                continue
+            seq = rec["seq"]
+            if live is None:
+                live = {m["filename"] for m in metadata if not m.get("deleted")}
+            filename = rec["entry"]["filename"]
+            if filename in live:
+                continue
+            live.add(filename)
+            vec = np.array([rec["vector"]], dtype=np.float32)
+            if index is None:
+                index = build_index(vec.shape[1], index_params(manifest))
+            index.add(vec)
+            metadata.append(rec["entry"])
+    return index, dict(manifest, seq=seq), offset, live
+
+def log_tail(path):
+    """回傳 (最後一筆完整紀錄的 seq, 完整紀錄結束的 byte 位置)；從檔尾往回讀，不必掃整份 log"""
+    if not os.path.exists(path):
+        return None, 0
+    with open(path, "rb") as f:
+        size = f.seek(0, os.SEEK_END)
+        pos, buf = size, b""
+        while pos > 0:
+            step = min(LOG_TAIL_CHUNK, pos)
+            pos -= step
+            f.seek(pos)
+            buf = f.read(step) + buf
+            # lines[-1] 是最後一個換行之後的殘行（檔案完整時為 b""）
+            lines = buf.split(b"\n")
+            if len(lines) >= 3 or (pos == 0 and len(lines) == 2):
+                return json.loads(lines[-2])["seq"], size - len(lines[-1])
+    return None, 0
+
+def append_log(user, kind, manifest, entry, vector, lock=None):
+    """
+    ingest 的寫入路徑（須持有寫入鎖，manifest 為持鎖後讀到的版本，可為 None）：
+    把一筆項目 append 到 log 並 fsync，回傳還沒併入 snapshot 的筆數
+    崩潰時寫到一半的最後一行先截掉，新紀錄才不會接在殘行後面
+    """
+    if lock is not None:
+        try:
+            lock.reacquire()
+        except LockError:
+            raise SnapshotConflict(f"{kind} write lock of user {user} expired before append")
+    path = snapshot_files(user, kind)["log"]
+    base = (manifest or {}).get("seq", 0)
+    last_seq, end = log_tail(path)
+    seq = max(base, last_seq or 0) + 1
+    rec = {"seq": seq, "entry": entry, "vector": [float(x) for x in vector]}
+    with open(path, "ab") as f:
+        if f.tell() > end:
+            f.truncate(end)
+        f.write((json.dumps(rec, ensure_ascii=False) + "\n").encode("utf-8"))
+        f.flush()
+        os.fsync(f.fileno())
+    return seq - base
+
+def checkpoint_due(manifest, pending):
+    return pending >= SNAPSHOT_CHECKPOINT_ENTRIES or time.time() - (manifest or {}).get("ts", 0) >= SNAPSHOT_CHECKPOINT_SECONDS
+
+def checkpoint_snapshot(user, kind, lock=None):
+    """把 log 併進新版本 snapshot 並清空 log（須持有寫入鎖）"""
+    index, metadata, manifest = load_snapshot(user, kind, replay=True)
+    if index is None:
+        return manifest
+    return commit_snapshot(user, kind, index, metadata, manifest, lock=lock)
+
+def commit_snapshot(user, kind, index, metadata, manifest, lock=None):
+    """
+    寫出新版本並原子替換 manifest；保留上一版讓還在讀的 reader 不受影響
+    lock 為持有中的寫入鎖：寫檔前延長 TTL，切換 manifest 前確認鎖仍屬於自己、
+    且磁碟上的 manifest 版本仍是讀取時的版本，否則丟 SnapshotConflict（log 不會被清空）
+    """
+    names = SNAPSHOT_KINDS[kind]
+    files = snapshot_files(user, kind)
+    version = manifest["version"] + 1
+
+    def fence():
+        if lock is not None:
+            try:
+                lock.reacquire()
+            except LockError:
+                raise SnapshotConflict(f"{kind} write lock of user {user} expired before commit")
+        current = read_manifest(user, kind, files["root"]) or {"version": 0}
+        if current["version"] != manifest["version"]:
+            raise SnapshotConflict(
+                f"{kind} manifest of user {user} moved to v{current['version']} while committing v{version}")
+
+    fence()
+    tag = f"v{version}-{uuid.uuid4().hex[:8]}"
+    index_name = f"{names['index']}_{user}.{tag}.index"
+    meta_name = f"{names['meta']}_{user}.{tag}.json"
+
+    atomic_write_bytes(os.path.join(files["root"], index_name), faiss.serialize_index(index).tobytes())
+    atomic_write_bytes(
+        os.path.join(files["root"], meta_name),
+        json.dumps(metadata, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    )
+
+    try:
+        fence()
+    except SnapshotConflict:
+        for name in (index_name, meta_name):
+            path = os.path.join(files["root"], name)
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+
+    new_manifest = {
+        "version": version,
+        "index": index_name,
+        "metadata": meta_name,
+        "ntotal": int(index.ntotal),
+        # tombstone 數量：查詢時據此多取幾筆，不必再掃 metadata
+        "deleted": sum(1 for m in metadata if m.get("deleted")),
+        "seq": manifest["seq"],
+        "ts": time.time(),
+        "previous": [manifest["index"], manifest["metadata"]] if "index" in manifest else [],
+        **{k: manifest[k] for k in INDEX_PARAM_KEYS if k in manifest},
+    }
+    atomic_write_bytes(files["manifest"], json.dumps(new_manifest, indent=2).encode("utf-8"))
+    set_gauge("index_vectors", new_manifest["ntotal"], user=user, kind=kind)
+
+    # log 內容都已進入 snapshot
+    if os.path.exists(files["log"]):
+        os.truncate(files["log"], 0)
+
+    # 刪除上上一版與舊格式檔案
+    stale = [os.path.join(files["root"], name) for name in manifest.get("previous", [])]
+    if manifest["version"] == 0:
+        stale += [files["legacy_index"], files["legacy_meta"]]
+    for path in stale:
+        if os.path.exists(path):
+            os.remove(path)
+
+    return new_manifest
+
+SNAPSHOT_LOCKS = {"image": "write_lock", "pdf": "pdf_write_lock"}
+
+snapshot_cache = OrderedDict()   # (user, kind) -> {"lock", "version", "root", "index", "metadata", "manifest", "offset", "live"}
+snapshot_cache_lock = threading.Lock()
+
+@contextmanager
+def cached_snapshot(user, kind):
+    """
+    查詢端使用：manifest 版本沒變就沿用記憶體中的 index 與 metadata，只重播 log 新增的行，
+    不必每次查詢都讀整份 index 與 metadata。yield (index, metadata, manifest)，
+    期間持有這份快取的鎖（faiss 的 add 與 search 不能同時進行），呼叫端不要在裡面 await
+    """
+    key = (user, kind)
+    with snapshot_cache_lock:
+        state = snapshot_cache.get(key)
+        if state is None:
+            state = snapshot_cache[key] = {"lock": threading.Lock(), "version": None}
+        snapshot_cache.move_to_end(key)
+        while len(snapshot_cache) > SNAPSHOT_CACHE_SIZE:
+            snapshot_cache.popitem(last=False)
+    with state["lock"]:
+        refresh_cached_snapshot(user, kind, state)
+        yield state["index"], state["metadata"], state["manifest"]
+
+def refresh_cached_snapshot(user, kind, state):
+    files = snapshot_files(user, kind)
+    for _ in range(SNAPSHOT_READ_RETRIES):
+        manifest = read_manifest(user, kind, files["root"]) or {"version": 0}
+        if (state["version"], state.get("root")) != (manifest["version"], files["root"]):
+            index, metadata, manifest = load_snapshot(user, kind)
+            state.update(version=manifest["version"], root=files["root"], index=index,
+                         metadata=metadata, manifest=manifest, offset=0, live=None)
+        state["index"], state["manifest"], state["offset"], state["live"] = replay_log(
+            files["log"], state["index"], state["metadata"], state["manifest"], state["offset"], state["live"])
+        # 重播期間 writer 做了 checkpoint（log 已清空重寫），剛才讀到的尾端不可信：重新載入
+        current = read_manifest(user, kind, files["root"]) or {"version": 0}
+        if current["version"] == state["version"]:
+            return
+        state["version"] = None
+    # checkpoint 太頻繁一直追不上：這次直接完整讀取，下次查詢再重建快取
+    state["index"], state["metadata"], state["manifest"] = load_snapshot(user, kind, replay=True)
+
+@contextmanager
+def timed_lock(key, timeout=SNAPSHOT_LOCK_TIMEOUT):
+    """取得 Redis 鎖並分別記錄等待時間與持有時間，yield 鎖本身讓 commit_snapshot 延長與檢查"""
+    lock_name = key.split(":", 1)[0]
+    t0 = time.time()
+    lock = context.redis.lock(key, timeout=timeout)
+    lock.acquire()
+    acquired = time.time()
+    observe("lock_wait_seconds", acquired - t0, lock=lock_name, service=context.service_name)
+    try:
+        yield lock
+    finally:
+        observe("lock_hold_seconds", time.time() - acquired, lock=lock_name, service=context.service_name)
+        try:
+            lock.release()
+        except LockError:
+            # 鎖已過期（commit_snapshot 會因此丟 SnapshotConflict），不要蓋掉原本的例外
+            print(f"⚠️ Lock {key} expired before release")
@@ -1,12 +1,14 @@
-import os, time, json, shutil, threading, zipfile, asyncio
+import os, time, json, shutil, threading, zipfile, asyncio, uuid, socket, sqlite3
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, UploadFile, File, HTTPException, Form
+from fastapi import FastAPI, UploadFile, File, HTTPException, Form, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, StreamingResponse
+from fastapi.responses import FileResponse, StreamingResponse, PlainTextResponse
 from pydantic import BaseModel
 from typing import List, Optional
 from redis import Redis
-import faiss
+from redis import asyncio as aioredis
 import numpy as np
 from sentence_transformers import SentenceTransformer
 from transformers import BlipProcessor, BlipForConditionalGeneration
@@ -24,6 +26,16 @@ from zipfile import ZipFile
 from dotenv import load_dotenv
 load_dotenv()
 
+from common import context
+from common.metrics import (
+    METRIC_LABEL_RE, METRICS_PREFIX, QUEUE_WAIT_BUCKETS, histogram_buckets, inc_counter, metric_labels, timed,
+)
+from common.shards import DATA_ROOTS, MIGRATING_PREFIX, USER_SHARD_HASH, ring_shard, root_available, user_root
+from common.snapshot import (
+    EMBED_MODEL, EMBED_MODELS, INDEX_METRICS, INDEX_TYPES, SNAPSHOT_KINDS, SNAPSHOT_LOCKS, SnapshotConflict,
+    atomic_write_bytes, build_index, cached_snapshot, commit_snapshot, index_params, load_snapshot, read_manifest, snapshot_files, timed_lock,
+)
+
 # ===== Auth imports =====
 from fastapi import Depends
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
@@ -50,8 +62,13 @@ PROCESSING_TIMEOUT    = 30
 MONITOR_INTERVAL      = 2
 SSE_PUSH_INTERVAL  = 1
 
-# 要監控的 worker 名稱清單
-WORKER_NAMES = ["worker1", "worker2", "worker3"]
+# 任務租約與 monitor leader 設定
+LEASE_ZSET            = "processing_leases"
+WORKER_TASKS_PREFIX   = "worker_tasks"
+REQUEUE_BATCH         = 500
+MONITOR_LEADER_KEY    = "monitor_leader"
+MONITOR_LEADER_TTL    = 3 * MONITOR_INTERVAL
+CONTROLLER_ID         = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
 
 # 定義 lifespan 以接管啟動時行為
 @asynccontextmanager
@@ -70,22 +87,67 @@ app.add_middleware(
 )
 
 # 資料與 Redis 設定
-DATA_DIR = "/data"
+DATA_DIR = os.getenv("DATA_DIR", "/data")
 UPLOAD_DIR = os.path.join(DATA_DIR, "uploads")
 os.makedirs(UPLOAD_DIR, exist_ok=True)
-# 確保有 users.json
-users_db_path = os.path.join(DATA_DIR, "users.json")
-if not os.path.exists(users_db_path):
-    with open(users_db_path, "w", encoding="utf-8") as f:
-        json.dump({}, f)
-redis = Redis(host="redis", port=6379, decode_responses=True)
+# 使用者資料：SQLite（WAL）以 username 為主鍵，查詢 O(1)、新增只寫一筆
+users_db_path = os.path.join(DATA_DIR, "users.db")
+LEGACY_USERS_JSON = os.path.join(DATA_DIR, "users.json")
+REDIS_HOST = os.getenv("REDIS_HOST", "redis")
+redis = Redis(host=REDIS_HOST, port=6379, decode_responses=True)
+# SSE 的 blocking XREAD 用 async client，避免卡住 event loop
+aredis = aioredis.Redis(host=REDIS_HOST, port=6379, decode_responses=True)
+
+# 分片儲存（DATA_ROOTS 與 hash ring 見 common/shards.py），users.db 只放在 DATA_DIR
+UPLOADS_INFLIGHT_PREFIX = "uploads_inflight"
+# rebalance 設定：上次完成時的 DATA_ROOTS 記在 SHARD_CONFIG_KEY，不同時就由 monitor leader 搬移
+SHARD_CONFIG_KEY = "shard_roots"
+REBALANCE_GUARD = "shard_rebalance"
+MIGRATION_DRAIN_TIMEOUT = 120
+MIGRATION_FLAG_TTL = 1800
 QUEUE_PREFIX = "image_queue"
+# 優先權 lane（與 worker 相同）：normal 沿用原本的 image_queue:{user}
+QUEUE_LANES = ("interactive", "normal", "bulk")
+DEFAULT_LANE = "normal"
+# 依單次上傳的張數 / 頁數分配 lane：少量走 interactive，大批匯入走 bulk
+INTERACTIVE_MAX_BATCH = 20
+BULK_MIN_BATCH = 200
 PROCESSING_SET_PREFIX = "processing_set"
 DONE_SET_PREFIX = "done_set"
-MONITOR_CHANNEL = "monitor_events"
-
-# FAISS 與 metadata 設定
-embedder = SentenceTransformer("all-MiniLM-L6-v2")
+# 監控事件：capped Redis Stream，SSE client 以 cursor 持續 XREAD 新事件
+MONITOR_STREAM = "monitor_stream"
+MONITOR_STREAM_MAXLEN = 10000
+MONITOR_BLOCK_MS = 15000
+LEGACY_MONITOR_LIST = "monitor_events"
+SERVICE_NAME = "controller"
+context.configure(redis, SERVICE_NAME)
+
+# 刪除 / compaction 設定：tombstone 比例超過門檻就在背景重建 index
+COMPACTION_THRESHOLD = 0.2
+COMPACTION_MIN_DELETED = 10
+# compaction 失敗後這段時間內不再排程，避免一直失敗時不停重試
+COMPACTION_RETRY_COOLDOWN = 300
+
+# 重建索引設定：每次從 metadata 取一段 caption 批次 encode
+REINDEX_CHUNK = 2048
+REINDEX_BATCH_SIZE = 128
+
+# 縮圖 / 預覽圖衍生檔設定（與 worker 相同的目錄配置）
+DERIVATIVE_SUBDIR = "derivatives"
+DERIVATIVE_VARIANTS = {
+    "thumb":   {"max_side": 320,  "quality": 75},
+    "preview": {"max_side": 1280, "quality": 82},
+}
+IMAGE_CACHE_CONTROL = "private, max-age=86400"
+
+# FAISS 與 metadata 設定（EMBED_MODEL 見 common/snapshot.py）
+# 依模型名稱快取：EMBED_MODELS 啟動時全部載入，reindex 換模型後 manifest 指向哪個模型查詢就用哪個
+embedders = {model: SentenceTransformer(model) for model in EMBED_MODELS}
+
+def get_embedder(model):
+    if model not in embedders:
+        raise ValueError(f"Embedding model {model} is not in EMBED_MODELS")
+    return embedders[model]
 
 COHERE_API_KEY = os.getenv("COHERE_API_KEY")
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
@@ -96,6 +158,7 @@ gemini = GenerativeModel("gemini-2.5-flash-preview-04-17")
 device = "cuda" if torch.cuda.is_available() else "cpu"
 blip_processor = BlipProcessor.from_pretrained("Salesforce/blip-image-captioning-base")
 blip_model = BlipForConditionalGeneration.from_pretrained("Salesforce/blip-image-captioning-base").to(device)
+BLIP_INPUT_SIZE = 384
 
 # ===== Auth 設定 =====
 SECRET_KEY = os.getenv("JWT_SECRET")
@@ -105,13 +168,64 @@ ACCESS_TOKEN_EXPIRE_MINUTES = 60
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/login")
 
-def load_users():
-    with open(users_db_path, "r", encoding="utf-8") as f:
-        return json.load(f)
-
-def save_users(u):
-    with open(users_db_path, "w", encoding="utf-8") as f:
-        json.dump(u, f, indent=2)
+# bcrypt 很耗 CPU，放在固定大小的 executor 執行，login 暴增時不會佔滿 event loop 與 FastAPI 的 threadpool
+AUTH_EXECUTOR = ThreadPoolExecutor(max_workers=int(os.getenv("AUTH_WORKERS", "4")), thread_name_prefix="auth")
+# 已驗證 token 的快取：SSE 重連與頻繁的 API 呼叫不必每次都 decode JWT
+TOKEN_CACHE_TTL = 60
+TOKEN_CACHE_SIZE = 10000
+token_cache = OrderedDict()  # token -> (user, 快取到期時間)
+
+_users_db = threading.local()
+
+def users_db():
+    """每個 thread 各自一條 SQLite 連線（sqlite3 連線不能跨 thread 共用）"""
+    conn = getattr(_users_db, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(users_db_path, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _users_db.conn = conn
+    return conn
+
+def init_users_db():
+    conn = users_db()
+    with conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, password TEXT NOT NULL)")
+    # 舊版的 users.json 匯入一次後改名保留
+    if os.path.exists(LEGACY_USERS_JSON):
+        with open(LEGACY_USERS_JSON, "r", encoding="utf-8") as f:
+            legacy = json.load(f)
+        with conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO users (username, password) VALUES (?, ?)",
+                [(name, u["password"]) for name, u in legacy.items()],
+            )
+        os.replace(LEGACY_USERS_JSON, LEGACY_USERS_JSON + ".migrated")
+        print(f"✅ Migrated {len(legacy)} users from users.json")
+
+init_users_db()
+
+def get_user_hash(username):
+    row = users_db().execute("SELECT password FROM users WHERE username = ?", (username,)).fetchone()
+    return row[0] if row else None
+
+def create_user(username, password):
+    """新增使用者，已存在時回傳 False（由主鍵保證，同時註冊也不會互相覆蓋）"""
+    hashed = hash_password(password)
+    try:
+        with users_db() as conn:
+            conn.execute("INSERT INTO users (username, password) VALUES (?, ?)", (username, hashed))
+        return True
+    except sqlite3.IntegrityError:
+        return False
+
+def authenticate(username, password):
+    hashed = get_user_hash(username)
+    if hashed is None:
+        # 使用者不存在也做一次 hash，回應時間不會透露帳號是否存在
+        pwd_context.dummy_verify()
+        return False
+    return verify_password(password, hashed)
 
 def verify_password(plain, hashed):
     return pwd_context.verify(plain, hashed)
@@ -126,67 +240,169 @@ def create_access_token(data: dict, expires_delta: timedelta = None):
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
 async def get_current_user(token: str = Depends(oauth2_scheme)):
+    now = time.time()
+    cached = token_cache.get(token)
+    if cached and cached[1] > now:
+        return cached[0]
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         user = payload.get("sub")
         if user is None:
             raise
-        return user
     except:
         raise HTTPException(status_code=401, detail="Invalid authentication credentials")
-
-# 偵測死掉節點 & 超時任務回收
+    # 快取時間不超過 token 本身的到期時間
+    token_cache[token] = (user, min(now + TOKEN_CACHE_TTL, payload.get("exp", now)))
+    token_cache.move_to_end(token)
+    while len(token_cache) > TOKEN_CACHE_SIZE:
+        token_cache.popitem(last=False)
+    return user
+
+def publish_event(event_type, **fields):
+    """寫入監控事件 stream（MAXLEN ~ 近似裁切，記憶體維持固定上限）"""
+    event = {"ts": time.time(), "type": event_type, **fields}
+    redis.xadd(MONITOR_STREAM, {"data": json.dumps(event)}, maxlen=MONITOR_STREAM_MAXLEN, approximate=True)
+    return event
+
+# 取出已到期的租約並放回各 user 的 queue（整批在 Redis 內原子完成）
+# member 格式為 "{user}:{image_path}"
+REQUEUE_EXPIRED_LUA = """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, member in ipairs(expired) do
+    local sep = string.find(member, ':', 1, true)
+    local user = string.sub(member, 1, sep - 1)
+    local item = string.sub(member, sep + 1)
+    local worker = redis.call('HGET', 'processing_workers', member)
+    if worker then
+        redis.call('SREM', '%(worker_tasks)s:' .. worker, member)
+    end
+    redis.call('ZREM', KEYS[1], member)
+    redis.call('SREM', '%(processing)s:' .. user, item)
+    redis.call('HDEL', 'processing_workers', member)
+    redis.call('DEL', '%(processing_ts)s' .. member)
+    redis.call('HSET', 'enqueue_ts:' .. user, item, ARGV[1])
+    -- 放回原本的 lane
+    local queue = '%(queue)s:' .. user
+    local lane = redis.call('HGET', 'processing_lanes', member)
+    redis.call('HDEL', 'processing_lanes', member)
+    if lane and lane ~= '%(default_lane)s' then
+        queue = queue .. ':' .. lane
+    end
+    redis.call('LPUSH', queue, item)
+end
+return expired
+""" % {
+    "worker_tasks": WORKER_TASKS_PREFIX,
+    "processing": PROCESSING_SET_PREFIX,
+    "processing_ts": PROCESSING_TS_PREFIX,
+    "queue": QUEUE_PREFIX,
+    "default_lane": DEFAULT_LANE,
+}
+
+# 死掉的 worker：把它手上所有任務的租約設為立即到期，交給上面的 script 回收
+EXPIRE_WORKER_TASKS_LUA = """
+local members = redis.call('SMEMBERS', KEYS[2])
+for _, member in ipairs(members) do
+    if redis.call('ZSCORE', KEYS[1], member) then
+        redis.call('ZADD', KEYS[1], 0, member)
+    end
+end
+redis.call('DEL', KEYS[2])
+return members
+"""
+
+# 續約 leader：只有目前持有者可以延長 TTL
+RENEW_LEADER_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+def is_monitor_leader():
+    """多個 controller replica 之間只有一個執行回收；leader 掛掉後 TTL 到期由其他 replica 接手"""
+    if redis.set(MONITOR_LEADER_KEY, CONTROLLER_ID, nx=True, ex=MONITOR_LEADER_TTL):
+        return True
+    return bool(redis.eval(RENEW_LEADER_LUA, 1, MONITOR_LEADER_KEY, CONTROLLER_ID, MONITOR_LEADER_TTL))
+
+# 偵測死掉節點 & 超時任務回收：成本與到期的任務數成正比，而不是所有處理中的任務
 def monitor_loop():
+    backfilled = False
     while True:
-        now = time.time()
-        # 1) 檢查死掉的 worker
-        active_workers = redis.smembers("active_workers")
-        for w in active_workers:
-            if not redis.exists(HEARTBEAT_PREFIX + w):
-                proc_map = redis.hgetall("processing_workers")
-                requeued = []
-                for item, worker in proc_map.items():
-                    if w == worker:
-                        # item 現在是 "{user}:{image_path}" 格式
-                        user, *path_parts = item.split(":", 1)
-                        image_path = path_parts[0]
-                        proc_key = f"{PROCESSING_SET_PREFIX}:{user}"
-                        queue_key = f"{QUEUE_PREFIX}:{user}"
-                        
-                        redis.srem(proc_key, image_path)
-                        redis.hdel("processing_workers", item)
-                        redis.lpush(queue_key, image_path)
-                        requeued.append(image_path)
-                
-                event = {"ts": now, "type": "worker_dead", "worker": w, "requeued": requeued}
-                redis.lpush(MONITOR_CHANNEL, json.dumps(event))
-                redis.srem("active_workers", w)
-        
-        # 2) 檢查每個 user 的 timeout 任務
-        active_users = redis.smembers("active_users")
-        for user in active_users:
-            proc_key = f"{PROCESSING_SET_PREFIX}:{user}"
-            for item in redis.smembers(proc_key):
-                ts_key = f"{PROCESSING_TS_PREFIX}{user}:{item}"
-                ts = redis.get(ts_key)
-                if ts and now - float(ts) > PROCESSING_TIMEOUT:
-                    # 回收到 per-user queue
-                    redis.srem(proc_key, item)
-                    redis.hdel("processing_workers", f"{user}:{item}")
-                    redis.delete(ts_key)
-                    redis.lpush(f"{QUEUE_PREFIX}:{user}", item)
-                    ev = {"ts": now, "type": "task_timeout", "user": user, "item": item}
-                    redis.lpush(MONITOR_CHANNEL, json.dumps(ev))
-        
+        try:
+            if is_monitor_leader():
+                if not backfilled:
+                    backfill_leases()
+                    backfilled = True
+                supervise_once()
+                maybe_rebalance()
+        except Exception as e:
+            print(f"⚠️ Monitor loop error: {e}")
         time.sleep(MONITOR_INTERVAL)
 
+def backfill_leases():
+    """升級前就在處理中的任務沒有租約，成為 leader 時補上一次"""
+    for user in redis.smembers("active_users"):
+        for item in redis.smembers(f"{PROCESSING_SET_PREFIX}:{user}"):
+            ts = redis.get(f"{PROCESSING_TS_PREFIX}{user}:{item}")
+            deadline = (float(ts) if ts else time.time()) + PROCESSING_TIMEOUT
+            redis.zadd(LEASE_ZSET, {f"{user}:{item}": deadline}, nx=True)
+
+def supervise_once():
+    now = time.time()
+    # 1) 檢查死掉的 worker：手上的任務租約立即到期
+    dead_tasks = {}
+    active_workers = list(redis.smembers("active_workers"))
+    pipe = redis.pipeline(transaction=False)
+    for w in active_workers:
+        pipe.exists(HEARTBEAT_PREFIX + w)
+    for w, alive in zip(active_workers, pipe.execute()):
+        if not alive:
+            members = redis.eval(EXPIRE_WORKER_TASKS_LUA, 2, LEASE_ZSET, f"{WORKER_TASKS_PREFIX}:{w}")
+            dead_tasks[w] = set(members)
+            redis.srem("active_workers", w)
+
+    # 2) 回收所有到期的租約
+    requeued = set()
+    while True:
+        batch = redis.eval(REQUEUE_EXPIRED_LUA, 1, LEASE_ZSET, now, REQUEUE_BATCH)
+        requeued.update(batch)
+        if len(batch) < REQUEUE_BATCH:
+            break
+
+    for w, members in dead_tasks.items():
+        items = [m.split(":", 1)[1] for m in members if m in requeued]
+        publish_event("worker_dead", worker=w, requeued=items)
+        inc_counter("tasks_requeued_total", len(items), reason="worker_dead")
+        requeued -= members
+
+    for member in requeued:
+        user, item = member.split(":", 1)
+        inc_counter("tasks_requeued_total", reason="timeout")
+        publish_event("task_timeout", user=user, item=item)
+
+def user_upload_root(user: str = Depends(get_current_user)):
+    """上傳期間記錄進行中的數量（搬移會等它歸零），回傳使用者的 root；搬移中的使用者暫時回 503"""
+    inflight = f"{UPLOADS_INFLIGHT_PREFIX}:{user}"
+    # 先加計數再檢查旗標，與 migrate_user 的「先設旗標再看計數」互相排除
+    redis.incr(inflight)
+    redis.expire(inflight, MIGRATION_FLAG_TTL)
+    try:
+        if redis.exists(f"{MIGRATING_PREFIX}:{user}"):
+            raise HTTPException(status_code=503, detail="User data is being moved to another shard, retry shortly",
+                                headers={"Retry-After": "30"})
+        yield user_root(user)
+    finally:
+        redis.decr(inflight)
+
 @app.post("/upload")
 def upload_zip(
     zip_file: UploadFile = File(...),
-    user: str = Depends(get_current_user)
+    user: str = Depends(get_current_user),
+    root: str = Depends(user_upload_root)
 ):
-    # 1) 先在程式碼裡產生 user 專屬 uploads 資料夾
-    user_upload_dir = os.path.join(DATA_DIR, "uploads", user)
+    # 1) 先在程式碼裡產生 user 專屬 uploads 資料夾（位於使用者所屬 shard 的 root 底下）
+    user_upload_dir = os.path.join(root, "uploads", user)
     os.makedirs(user_upload_dir, exist_ok=True)
 
     # 2) 之後所有路徑都從 user_upload_dir 開始
@@ -203,29 +419,33 @@ def upload_zip(
 
     count = 0
     saved_paths = []
-    for root, _, files in os.walk(temp_dir):
+    for dirpath, _, files in os.walk(temp_dir):
         for fname in files:
             if fname.lower().endswith((".jpg", ".jpeg", ".png", ".heic")):
-                src = os.path.join(root, fname)
+                src = os.path.join(dirpath, fname)
                 dst = os.path.join(user_upload_dir, fname)
                 shutil.move(src, dst)
-                rel = os.path.relpath(dst, DATA_DIR)
-                redis.lpush(f"{QUEUE_PREFIX}:{user}", rel)
+                rel = os.path.relpath(dst, root)
                 saved_paths.append(rel)
                 count += 1
 
+    lane = lane_for_batch(count)
+    for rel in saved_paths:
+        enqueue(user, rel, lane)
+
     shutil.rmtree(temp_dir)
     return {"message": f"Uploaded and queued {count} images.", "queued": saved_paths}
 
 @app.post("/upload/pdf")
 async def upload_pdf_or_zip(
     upload_file: UploadFile = File(...),
-    user: str = Depends(get_current_user)
+    user: str = Depends(get_current_user),
+    root: str = Depends(user_upload_root)
 ):
     filename = upload_file.filename.lower()
 
     # 創建用戶專屬上傳目錄
-    user_upload_dir = os.path.join(DATA_DIR, "uploads", user)
+    user_upload_dir = os.path.join(root, "uploads", user)
     os.makedirs(user_upload_dir, exist_ok=True)
     
     # PDF專屬子目錄
@@ -244,14 +464,17 @@ async def upload_pdf_or_zip(
         os.remove(temp_path)
 
         # 處理所有解壓後的圖片
-        for root, _, files in os.walk(pdf_upload_dir):
+        for dirpath, _, files in os.walk(pdf_upload_dir):
             for fname in files:
                 if fname.lower().endswith((".jpg", ".jpeg", ".png")):
-                    full_path = os.path.join(root, fname)
-                    rel_path = os.path.relpath(full_path, DATA_DIR)
-                    redis.lpush(f"{QUEUE_PREFIX}:{user}", rel_path)
+                    full_path = os.path.join(dirpath, fname)
+                    rel_path = os.path.relpath(full_path, root)
                     saved_paths.append(rel_path)
 
+        lane = lane_for_batch(len(saved_paths))
+        for rel_path in saved_paths:
+            enqueue(user, rel_path, lane)
+
         return {
             "message": f"Uploaded ZIP and queued {len(saved_paths)} image(s).",
             "queued": saved_paths
@@ -269,13 +492,14 @@ async def upload_pdf_or_zip(
             raise HTTPException(status_code=400, detail="No images extracted from PDF")
 
         pdf_base = os.path.splitext(upload_file.filename)[0]
+        lane = lane_for_batch(len(images))
         for i, img in enumerate(images):
             fname = f"{pdf_base}_page_{i:03}.jpg"
             full_path = os.path.join(pdf_upload_dir, fname)
             img.save(full_path, "JPEG")
 
-            rel_path = os.path.relpath(full_path, DATA_DIR)
-            redis.lpush(f"{QUEUE_PREFIX}:{user}", rel_path)
+            rel_path = os.path.relpath(full_path, root)
+            enqueue(user, rel_path, lane)
             saved_paths.append(rel_path)
 
         return {
@@ -295,36 +519,35 @@ async def search_pdf(
     if not query:
         raise HTTPException(status_code=400, detail="Missing query")
     
-    user_pdf_index = os.path.join(DATA_DIR, f"pdf_index_{user}.index")
-    user_pdf_meta = os.path.join(DATA_DIR, f"pdf_metadata_{user}.json")
-    
-    if not os.path.exists(user_pdf_index) or not os.path.exists(user_pdf_meta):
-        raise HTTPException(status_code=404, detail="PDF FAISS index or metadata not found")
-
     # 使用 Cohere 將查詢轉成向量
     input_obj = {
         "content": [{"type": "text", "text": query}]
     }
-    response = co.embed(
-        model="embed-v4.0",
-        inputs=[input_obj],
-        input_type="search_query",
-        embedding_types=["float"]
-    )
+    with timed("cohere"):
+        response = co.embed(
+            model="embed-v4.0",
+            inputs=[input_obj],
+            input_type="search_query",
+            embedding_types=["float"]
+        )
     query_vec = np.array(response.embeddings.float_[0]).astype("float32").reshape(1, -1)
 
-    # 查詢 FAISS
-    index = faiss.read_index(user_pdf_index)
-    with open(user_pdf_meta, "r", encoding="utf-8") as f:
-        metadata = json.load(f)
-
-    top_k = min(top_k, len(metadata))
-    D, I = index.search(query_vec, top_k)
+    # 查詢 FAISS（記憶體中的 snapshot + log 尾端，不需持有寫入鎖）
+    with cached_snapshot(user, "pdf") as (index, metadata, manifest):
+        if index is None or not metadata:
+            raise HTTPException(status_code=404, detail="PDF FAISS index or metadata not found")
+        k = min(top_k + manifest.get("deleted", 0), index.ntotal)
+        with timed("faiss_search"):
+            D, I = index.search(query_vec, k)
+        hits = [(metadata[idx], dist) for idx, dist in zip(I[0], D[0])
+                if 0 <= idx < len(metadata) and not metadata[idx].get("deleted")]
+    if not hits:
+        raise HTTPException(status_code=404, detail="No matching PDF page found")
 
     # 取第一個結果丟給 Gemini
-    result = metadata[I[0][0]]
+    result, best_dist = hits[0]
     filename = result["filename"]
-    image_path = os.path.join("/data", filename)
+    image_path = os.path.join(user_root(user), filename)
 
     try:
         img = Image.open(image_path)
@@ -343,7 +566,8 @@ async def search_pdf(
 
         User Question: {query}
         """, img]
-        response = gemini.generate_content(prompt)
+        with timed("gemini"):
+            response = gemini.generate_content(prompt)
         answer = response.text.strip()
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Gemini failed: {e}")
@@ -352,7 +576,7 @@ async def search_pdf(
         "query": query,
         "top_result": {
             "filename": filename,
-            "similarity": float(1 - D[0][0] / 100),
+            "similarity": float(1 - best_dist / 100),
             "image_url": f"/image/{filename}"
         },
         "gemini_answer": answer
@@ -365,31 +589,31 @@ async def search(
     top_k: Optional[int] = 5,
     user: str = Depends(get_current_user)
 ):
-    user_meta = os.path.join(DATA_DIR, f"metadata_{user}.json")
-    user_index = os.path.join(DATA_DIR, f"index_file_{user}.index")
-    
-    if not os.path.exists(user_meta) or not os.path.exists(user_index):
-        raise HTTPException(status_code=400, detail="Metadata or index not found")
-    
+    # 記憶體中的 snapshot + log 尾端（不需持有寫入鎖），先確認有資料並取得 embedding 參數
+    with cached_snapshot(user, "image") as (index, metadata, manifest):
+        if index is None or not metadata:
+            raise HTTPException(status_code=400, detail="Metadata or index not found")
+        params = index_params(manifest)
+
     if (query and image and image.filename != "") or (not query and (not image or image.filename == "")):
         raise HTTPException(status_code=400, detail="Must provide either text or image, not both or neither.")
 
-    # 載入資料
-    with open(user_meta, "r", encoding="utf-8") as f:
-        metadata = json.load(f)
-    index = faiss.read_index(user_index)
-
     # 文字或圖片轉換為 query 向量
     device = "cuda" if torch.cuda.is_available() else "cpu"
 
     if image:
         image_bytes = await image.read()
-        img = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+        img = Image.open(io.BytesIO(image_bytes))
+        # JPEG 直接以接近 BLIP 輸入的解析度解碼，再縮成 384x384
+        img.draft("RGB", (BLIP_INPUT_SIZE, BLIP_INPUT_SIZE))
+        img = img.convert("RGB")
+        blip_input = img.resize((BLIP_INPUT_SIZE, BLIP_INPUT_SIZE), Image.BICUBIC, reducing_gap=3.0)
 
         # Run BLIP to get caption
-        inputs = blip_processor(img, return_tensors="pt").to(device)
-        out = blip_model.generate(**inputs, max_length=50)
-        caption = blip_processor.decode(out[0], skip_special_tokens=True)
+        with timed("blip"):
+            inputs = blip_processor(blip_input, return_tensors="pt").to(device)
+            out = blip_model.generate(**inputs, max_length=50)
+            caption = blip_processor.decode(out[0], skip_special_tokens=True)
 
         # 預設 metadata
         country = None
@@ -417,7 +641,8 @@ async def search(
                         lat_decimal = dms_to_decimal(lat, lat_ref)
                         lon_decimal = dms_to_decimal(lon, lon_ref)
 
-                        location = geolocator.reverse((lat_decimal, lon_decimal), language="en", timeout=10)
+                        with timed("geocode"):
+                            location = geolocator.reverse((lat_decimal, lon_decimal), language="en", timeout=10)
                         if location and "address" in location.raw:
                             addr = location.raw["address"]
                             country = addr.get("country")
@@ -429,57 +654,499 @@ async def search(
         query = f"{caption}. Location: {city or ''}, {country or ''}. Date: {date_str or ''}."
         print(f"🖼️ Final query from image: {query}")
 
-    query_vec = embedder.encode(query)
-    top_k = min(top_k, len(metadata))
-    D, I = index.search(np.array([query_vec]), top_k)
-
+    # 用建立這份 index 的模型 embed 查詢
+    with timed("embed"):
+        query_vec = encode_texts([query], params)
+
+    with cached_snapshot(user, "image") as (index, metadata, manifest):
+        # embed 期間 reindex 可能已切換模型
+        if index_params(manifest) != params:
+            params = index_params(manifest)
+            query_vec = encode_texts([query], params)
+        # 多取 tombstone 數量的結果，刪除的項目直接在記憶體中略過
+        k = min(top_k + manifest.get("deleted", 0), index.ntotal)
+        with timed("faiss_search"):
+            D, I = index.search(query_vec, k)
+        hits = [(metadata[idx], dist) for idx, dist in zip(I[0], D[0])
+                if 0 <= idx < len(metadata) and not metadata[idx].get("deleted")][:top_k]
+
+    root = user_root(user)
     results = []
-    for idx, dist in zip(I[0], D[0]):
-        info = metadata[idx]
+    for info, dist in hits:
         results.append({
             "filename": info["filename"],
             "caption": info["caption"],
-            "similarity": float(1 - dist / 100),
-            "image_path": os.path.join(DATA_DIR, info["filename"])
+            "similarity": float(dist) if params["metric"] == "ip" else float(1 - dist / 100),
+            "image_path": os.path.join(root, info["filename"])
         })
     return {"results": results}
 
 
+def encode_texts(texts, params, **kwargs):
+    """用 manifest 指定的模型 embed；inner product 時先正規化，分數即 cosine similarity"""
+    vecs = get_embedder(params["embed_model"]).encode(
+        texts, normalize_embeddings=params["metric"] == "ip", **kwargs)
+    return np.asarray(vecs, dtype=np.float32)
+
+def compact_snapshot(user, kind):
+    """把 tombstone 從 index 與 metadata 中真正移除，產生新版本"""
+    with timed_lock(f"{SNAPSHOT_LOCKS[kind]}:{user}") as lock:
+        index, metadata, manifest = load_snapshot(user, kind, replay=True)
+        dead = [i for i, m in enumerate(metadata) if m.get("deleted")]
+        if index is None or not dead:
+            return 0
+        params = index_params(manifest)
+        if params["index_type"] == "flat":
+            # IndexFlat 的 id 就是列號，remove_ids 之後其餘列往前移，與 metadata 的過濾結果一致
+            index.remove_ids(np.array(dead, dtype=np.int64))
+        else:
+            # HNSW 不支援 remove_ids：取出保留的向量重建
+            keep = [i for i, m in enumerate(metadata) if not m.get("deleted")]
+            vecs = index.reconstruct_n(0, index.ntotal)[keep]
+            index = build_index(index.d, params)
+            index.add(vecs)
+        metadata = [m for m in metadata if not m.get("deleted")]
+        commit_snapshot(user, kind, index, metadata, manifest, lock=lock)
+    print(f"🧹 Compacted {kind} index for user {user}: removed {len(dead)} tombstones")
+    return len(dead)
+
+def maybe_schedule_compaction(user, kind, manifest):
+    deleted = manifest.get("deleted", 0)
+    if deleted < COMPACTION_MIN_DELETED or deleted < manifest["ntotal"] * COMPACTION_THRESHOLD:
+        return
+    cooldown = f"compaction_cooldown:{kind}:{user}"
+    if redis.exists(cooldown):
+        return
+    # 同一個 user 同時只跑一個 compaction
+    guard = f"compaction:{kind}:{user}"
+    if not redis.set(guard, time.time(), nx=True, ex=300):
+        return
+
+    def run():
+        try:
+            compact_snapshot(user, kind)
+        except Exception as e:
+            print(f"⚠️ Compaction failed for {kind} index of user {user}: {e}")
+            redis.set(cooldown, time.time(), ex=COMPACTION_RETRY_COOLDOWN)
+            redis.delete(guard)
+            return
+        redis.delete(guard)
+        # 只在成功後重新檢查：compaction 期間的刪除不會被漏掉
+        recheck_compaction(user, kind)
+
+    threading.Thread(target=run, daemon=True).start()
+
+def recheck_compaction(user, kind):
+    """guard 釋放後重新檢查門檻：持有 guard 期間發生的刪除不會被漏掉"""
+    try:
+        manifest = read_manifest(user, kind)
+    except (OSError, ValueError) as e:
+        print(f"⚠️ Failed to re-check compaction for {kind} index of user {user}: {e}")
+        return
+    if manifest:
+        maybe_schedule_compaction(user, kind, manifest)
+
+def embedding_text(entry):
+    """由 metadata 組出要 embed 的文字，必須與 worker 的格式一致"""
+    return f"{entry['caption']}. Location: {entry.get('city')}, {entry.get('country')}. Date: {entry.get('date') or ''}."
+
+def encode_entries(entries, params):
+    return encode_texts(
+        [embedding_text(m) for m in entries],
+        params,
+        batch_size=REINDEX_BATCH_SIZE,
+        convert_to_numpy=True,
+    )
+
+def publish_reindex_progress(user, state, done, total, **extra):
+    status = publish_event(f"reindex_{state}", user=user, done=done, total=total, **extra)
+    redis.set(f"reindex_status:{user}", json.dumps(status))
+
+def reindex_user(user, params):
+    """
+    用已存的 caption / EXIF 欄位以 params 指定的模型重新 embed，另建一份新 index，最後持鎖原子切換 manifest
+    重建期間 worker 仍可寫入：切換前會補上新增的列並套用期間內的刪除
+    切換前查詢與 worker 都照舊 manifest 的模型；切換後 manifest 記錄新的模型、index 類型與距離
+    """
+    _, metadata, start_manifest = load_snapshot(user, "image")
+    total = len(metadata)
+    dim = get_embedder(params["embed_model"]).get_sentence_embedding_dimension()
+    new_index = build_index(dim, params)
+    new_meta = []
+    source_rows = []  # new_meta[j] 對應舊 metadata 的列號
+
+    publish_reindex_progress(user, "started", 0, total)
+    for start in range(0, total, REINDEX_CHUNK):
+        rows = [i for i in range(start, min(start + REINDEX_CHUNK, total)) if not metadata[i].get("deleted")]
+        if rows:
+            new_index.add(encode_entries([metadata[i] for i in rows], params))
+            new_meta.extend(dict(metadata[i]) for i in rows)
+            source_rows.extend(rows)
+        publish_reindex_progress(user, "progress", min(start + REINDEX_CHUNK, total), total)
+
+    with timed_lock(f"write_lock:{user}") as lock:
+        _, current, manifest = load_snapshot(user, "image", replay=True)
+        # 依列號合併：列數變少或版本倒退表示期間被 reset 過，舊列號已經對不上
+        if len(current) < total or manifest["version"] < start_manifest["version"]:
+            raise RuntimeError("Index was reset while reindexing; aborted")
+        # 重建期間被刪除的項目
+        for j, i in enumerate(source_rows):
+            if current[i].get("deleted"):
+                new_meta[j]["deleted"] = True
+        # 重建期間新加入的項目（worker 用的是舊模型，一律以新模型重算）
+        tail = [m for m in current[total:] if not m.get("deleted")]
+        if tail:
+            new_index.add(encode_entries(tail, params))
+            new_meta.extend(tail)
+        commit_snapshot(user, "image", new_index, new_meta, dict(manifest, **params), lock=lock)
+
+    publish_reindex_progress(user, "done", len(current), len(current), ntotal=int(new_index.ntotal), **params)
+    print(f"🔁 Reindexed {new_index.ntotal} vectors for user {user} with {params['embed_model']} "
+          f"({params['index_type']}, {params['metric']})")
+
+# ===== 分片儲存與線上搬移 =====
+def user_data_files(user, root):
+    """使用者在 root 底下的所有資料（相對路徑）；manifest 是 commit point，排在最後複製"""
+    rels = [os.path.join("uploads", user)]
+    rels += [os.path.join(DERIVATIVE_SUBDIR, v, "uploads", user) for v in DERIVATIVE_VARIANTS]
+    manifests = []
+    for kind in SNAPSHOT_KINDS:
+        files = snapshot_files(user, kind, root)
+        manifest = read_manifest(user, kind, root) or {}
+        rels += [manifest[k] for k in ("index", "metadata") if k in manifest] + manifest.get("previous", [])
+        rels += [os.path.relpath(files[k], root) for k in ("log", "legacy_index", "legacy_meta")]
+        manifests.append(os.path.relpath(files["manifest"], root))
+    return [rel for rel in rels + manifests if os.path.exists(os.path.join(root, rel))]
+
+def migrate_user(user, src, dst):
+    """
+    線上把使用者從 src 搬到 dst，只暫停這個使用者：
+    1) 設 migrating 旗標：worker 不再領取、新上傳回 503，等處理中的任務與上傳結束
+    2) 持有 index 寫入鎖複製檔案，落盤後切換 user_shard，之後的讀寫都走 dst
+    3) 刪除 src 上的舊檔
+    忙碌中（compaction / reindex 執行中或等不到清空）或任一邊沒掛載時回傳 False，下一輪再試
+    """
+    if not (root_available(src) and root_available(dst)):
+        return False
+    flag = f"{MIGRATING_PREFIX}:{user}"
+    if not redis.set(flag, dst, nx=True, ex=MIGRATION_FLAG_TTL):
+        return False
+    held = []
+    try:
+        for kind in SNAPSHOT_KINDS:
+            guard = f"compaction:{kind}:{user}"
+            if not redis.set(guard, time.time(), nx=True, ex=MIGRATION_FLAG_TTL):
+                return False
+            held.append(guard)
+
+        deadline = time.time() + MIGRATION_DRAIN_TIMEOUT
+        while (redis.scard(f"{PROCESSING_SET_PREFIX}:{user}")
+               or int(redis.get(f"{UPLOADS_INFLIGHT_PREFIX}:{user}") or 0) > 0):
+            if time.time() > deadline:
+                print(f"⚠️ Timed out waiting for user {user} to go idle, will retry migration later")
+                return False
+            time.sleep(1)
+
+        t0 = time.time()
+        with redis.lock(f"{SNAPSHOT_LOCKS['image']}:{user}", timeout=MIGRATION_FLAG_TTL), \
+             redis.lock(f"{SNAPSHOT_LOCKS['pdf']}:{user}", timeout=MIGRATION_FLAG_TTL):
+            rels = user_data_files(user, src)
+            for rel in rels:
+                src_path, dst_path = os.path.join(src, rel), os.path.join(dst, rel)
+                os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+                if os.path.isdir(src_path):
+                    shutil.copytree(src_path, dst_path, dirs_exist_ok=True)
+                else:
+                    shutil.copy2(src_path, dst_path)
+            os.sync()
+            redis.hset(USER_SHARD_HASH, user, dst)
+
+        for rel in rels:
+            path = os.path.join(src, rel)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            elif os.path.exists(path):
+                os.remove(path)
+        seconds = round(time.time() - t0, 3)
+        publish_event("shard_migrated", user=user, source=src, target=dst, files=len(rels), seconds=seconds)
+        print(f"📦 Moved user {user} from {src} to {dst} in {seconds}s")
+        return True
+    finally:
+        redis.delete(flag, *held)
+
+def rebalance_shards():
+    """逐一搬移配置與 hash ring 不一致的使用者，回傳尚未完成的數量；全部完成才記下目前的 DATA_ROOTS"""
+    for user in redis.smembers("active_users"):
+        user_root(user)  # 補上舊使用者的配置
+    pending = 0
+    for user, root in redis.hgetall(USER_SHARD_HASH).items():
+        target = ring_shard(user)
+        if root == target:
+            continue
+        # 來源或目標沒掛載：不能搬（目標會寫進容器自己的檔案系統），留到掛載後再搬
+        unmounted = [r for r in (root, target) if not root_available(r)]
+        if unmounted:
+            print(f"⚠️ Shard {', '.join(unmounted)} for user {user} is not mounted on this controller")
+            pending += 1
+            continue
+        try:
+            moved = migrate_user(user, root, target)
+        except Exception as e:
+            print(f"⚠️ Failed to move user {user} from {root} to {target}: {e}")
+            moved = False
+        pending += 0 if moved else 1
+    if pending == 0:
+        redis.set(SHARD_CONFIG_KEY, json.dumps(DATA_ROOTS))
+    return pending
+
+def maybe_rebalance():
+    """DATA_ROOTS 與上次 rebalance 完成時不同（例如新增了 root）就在背景搬移"""
+    if redis.get(SHARD_CONFIG_KEY) == json.dumps(DATA_ROOTS):
+        return
+    if not redis.set(REBALANCE_GUARD, CONTROLLER_ID, nx=True, ex=MIGRATION_FLAG_TTL):
+        return
+
+    def run():
+        try:
+            pending = rebalance_shards()
+            if pending:
+                print(f"⚠️ Rebalance left {pending} user(s) pending, retrying later")
+        except Exception as e:
+            print(f"⚠️ Shard rebalance failed: {e}")
+        finally:
+            redis.delete(REBALANCE_GUARD)
+
+    threading.Thread(target=run, daemon=True).start()
+
+def queue_key(user, lane=DEFAULT_LANE):
+    if lane == DEFAULT_LANE:
+        return f"{QUEUE_PREFIX}:{user}"
+    return f"{QUEUE_PREFIX}:{user}:{lane}"
+
+def lane_for_batch(count):
+    if count <= INTERACTIVE_MAX_BATCH:
+        return "interactive"
+    if count >= BULK_MIN_BATCH:
+        return "bulk"
+    return DEFAULT_LANE
+
+def enqueue(user, rel_path, lane=DEFAULT_LANE):
+    """放入使用者該 lane 的佇列並記下時間，worker 取出時據此計算排隊時間"""
+    redis.hset(f"enqueue_ts:{user}", rel_path, time.time())
+    redis.lpush(queue_key(user, lane), rel_path)
+
+def backlog_age():
+    """所有使用者佇列中最舊那筆已經等了多久（秒）"""
+    now = time.time()
+    pairs = [(u, lane) for u in redis.smembers("active_users") for lane in QUEUE_LANES]
+    pipe = redis.pipeline(transaction=False)
+    for u, lane in pairs:
+        pipe.lindex(queue_key(u, lane), -1)  # worker 從右邊 rpop，最右邊最舊
+    oldest = pipe.execute()
+    pipe = redis.pipeline(transaction=False)
+    for (u, _), item in zip(pairs, oldest):
+        pipe.hget(f"enqueue_ts:{u}", item or "")
+    ages = [now - float(ts) for ts in pipe.execute() if ts]
+    return round(max(ages), 3) if ages else 0.0
+
+def queue_lengths():
+    """{(user, lane): 長度}，所有 LLEN 用同一個 pipeline 送出"""
+    pairs = [(u, lane) for u in redis.smembers("active_users") for lane in QUEUE_LANES]
+    pipe = redis.pipeline(transaction=False)
+    for u, lane in pairs:
+        pipe.llen(queue_key(u, lane))
+    return dict(zip(pairs, pipe.execute()))
+
+def histogram_quantile(counts, q, buckets):
+    """counts 為 {bucket 上界: 個數}，在 bucket 內線性內插（與 Prometheus histogram_quantile 相同）"""
+    total = sum(counts.values())
+    if not total:
+        return None
+    rank = q * total
+    cumulative, lower = 0, 0.0
+    for b in buckets + ("+Inf",):
+        n = counts.get(str(b), 0)
+        if n and cumulative + n >= rank:
+            if b == "+Inf":
+                return lower
+            return round(lower + (b - lower) * (rank - cumulative) / n, 4)
+        cumulative += n
+        if b != "+Inf":
+            lower = b
+    return lower
+
+def lane_wait_stats():
+    """各 lane 的隊列長度與 enqueue → claim 等待時間的 p50 / p95 / p99"""
+    buckets = {lane: {} for lane in QUEUE_LANES}
+    for field, value in redis.hgetall(f"{METRICS_PREFIX}:hist:queue_wait_seconds").items():
+        lbl, part = field.rsplit("|", 1)
+        if part in ("sum", "count"):
+            continue
+        labels = dict(METRIC_LABEL_RE.findall(lbl))
+        # 加入 lane 之前記錄的資料都算在 normal
+        lane = labels.get("lane", DEFAULT_LANE)
+        counts = buckets.setdefault(lane, {})
+        counts[part] = counts.get(part, 0) + float(value)
+
+    lengths = queue_lengths()
+    stats = {}
+    for lane, counts in buckets.items():
+        stats[lane] = {
+            "length": sum(n for (_, l), n in lengths.items() if l == lane),
+            "count": int(sum(counts.values())),
+            "p50": histogram_quantile(counts, 0.5, QUEUE_WAIT_BUCKETS),
+            "p95": histogram_quantile(counts, 0.95, QUEUE_WAIT_BUCKETS),
+            "p99": histogram_quantile(counts, 0.99, QUEUE_WAIT_BUCKETS),
+        }
+    return stats
+
+def render_prometheus():
+    lines = []
+    for name in sorted(redis.smembers(f"{METRICS_PREFIX}:hist_names")):
+        series = {}
+        for field, value in redis.hgetall(f"{METRICS_PREFIX}:hist:{name}").items():
+            lbl, part = field.rsplit("|", 1)
+            series.setdefault(lbl, {})[part] = float(value)
+        lines.append(f"# TYPE {name} histogram")
+        for lbl, parts in sorted(series.items()):
+            cumulative = 0
+            for b in histogram_buckets(name) + ("+Inf",):
+                cumulative += parts.get(str(b), 0)
+                le = ",".join(x for x in (lbl, f'le="{b}"') if x)
+                lines.append(f"{name}_bucket{{{le}}} {int(cumulative)}")
+            lines.append(f"{name}_sum{{{lbl}}} {parts.get('sum', 0)}")
+            lines.append(f"{name}_count{{{lbl}}} {int(parts.get('count', 0))}")
+    for kind in ("counter", "gauge"):
+        for name in sorted(redis.smembers(f"{METRICS_PREFIX}:{kind}_names")):
+            lines.append(f"# TYPE {name} {kind}")
+            for lbl, value in sorted(redis.hgetall(f"{METRICS_PREFIX}:{kind}:{name}").items()):
+                lines.append(f"{name}{{{lbl}}} {value}")
+
+    # 即時計算的 gauge
+    lines.append("# TYPE queue_length gauge")
+    for (u, lane), n in sorted(queue_lengths().items()):
+        lines.append(f"queue_length{{{metric_labels({'lane': lane, 'user': u})}}} {n}")
+    lines.append("# TYPE backlog_age_seconds gauge")
+    lines.append(f"backlog_age_seconds {backlog_age()}")
+    return "\n".join(lines) + "\n"
+
+def derivative_path(root, rel_path, variant):
+    base = os.path.splitext(rel_path)[0]
+    return os.path.join(root, DERIVATIVE_SUBDIR, variant, base + ".webp")
+
+def make_derivative(src_path, root, rel_path, variant):
+    """worker 尚未產生（或舊資料沒有）衍生檔時，在第一次請求時補產生"""
+    spec = DERIVATIVE_VARIANTS[variant]
+    out_path = derivative_path(root, rel_path, variant)
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    img = Image.open(src_path)
+    # JPEG 可直接以縮小的解析度解碼
+    img.draft("RGB", (spec["max_side"], spec["max_side"]))
+    img = img.convert("RGB")
+    img.thumbnail((spec["max_side"], spec["max_side"]), Image.LANCZOS)
+    # worker 或其他請求可能同時產生同一個檔案：各自寫唯一的暫存檔再 rename
+    buf = io.BytesIO()
+    img.save(buf, "WEBP", quality=spec["quality"], method=4)
+    atomic_write_bytes(out_path, buf.getvalue())
+    return out_path
+
 @app.get("/image/{path:path}")
-def get_image(path: str):
-    full = os.path.join(DATA_DIR, path)
+def get_image(path: str, request: Request, variant: Optional[str] = None):
+    # 只允許 uploads/{user}/... 底下的檔案：正規化後不能帶 ..、不能是絕對路徑
+    path = os.path.normpath(path)
+    parts = path.split(os.sep)
+    if os.path.isabs(path) or len(parts) < 3 or parts[0] != "uploads" or ".." in parts:
+        raise HTTPException(status_code=400, detail="Invalid image path")
+    # 依使用者的 shard 找 root；只查配置，不替未知的使用者建立配置
+    root = redis.hget(USER_SHARD_HASH, parts[1]) or DATA_DIR
+    full = os.path.join(root, path)
+    # symlink 也不能指到 uploads 之外
+    uploads_dir = os.path.realpath(os.path.join(root, "uploads"))
+    if os.path.commonpath([os.path.realpath(full), uploads_dir]) != uploads_dir:
+        raise HTTPException(status_code=400, detail="Invalid image path")
 
     if not os.path.isfile(full):
         raise HTTPException(status_code=404, detail="Image not found")
 
-    return FileResponse(full)
-
+    # variant=thumb / preview 時改送衍生檔，失敗則退回原圖
+    if variant and variant != "original":
+        if variant not in DERIVATIVE_VARIANTS:
+            raise HTTPException(status_code=400, detail=f"Unknown variant: {variant}")
+        derived = derivative_path(root, path, variant)
+        if not os.path.isfile(derived):
+            try:
+                derived = make_derivative(full, root, path, variant)
+            except Exception as e:
+                print(f"⚠️ Failed to build {variant} for {path}: {e}")
+                derived = None
+        if derived:
+            full = derived
 
+    # 以 mtime + size 產生 strong ETag，支援 If-None-Match 條件式請求
+    st = os.stat(full)
+    etag = f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+    headers = {"ETag": etag, "Cache-Control": IMAGE_CACHE_CONTROL}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        tags = [t.strip() for t in if_none_match.split(",")]
+        if "*" in tags or etag in tags:
+            return Response(status_code=304, headers=headers)
 
-@app.post("/reset")
-def reset_system(user: str = Depends(get_current_user)):
-    # 只刪除該使用者的索引和元數據
-    user_meta = os.path.join(DATA_DIR, f"metadata_{user}.json")
-    user_index = os.path.join(DATA_DIR, f"index_file_{user}.index")
-    user_pdf_index = os.path.join(DATA_DIR, f"pdf_index_{user}.index")
-    user_pdf_meta = os.path.join(DATA_DIR, f"pdf_metadata_{user}.json")
-    
-    if os.path.exists(user_index): os.remove(user_index)
-    with open(user_meta, "w", encoding="utf-8") as f: json.dump([], f)
+    # FileResponse 本身會處理 Range 請求（206 Partial Content）
+    return FileResponse(full, headers=headers)
 
-    if os.path.exists(user_pdf_index): os.remove(user_pdf_index)
-    with open(user_pdf_meta, "w", encoding="utf-8") as f: json.dump([], f)
 
-    # 清除用戶專屬上傳目錄
-    user_upload_dir = os.path.join(DATA_DIR, "uploads", user)
-    if os.path.exists(user_upload_dir): 
-        shutil.rmtree(user_upload_dir)
-        os.makedirs(user_upload_dir, exist_ok=True)
 
-    # 清空使用者的佇列
-    redis.delete(f"{QUEUE_PREFIX}:{user}", f"{PROCESSING_SET_PREFIX}:{user}", f"{DONE_SET_PREFIX}:{user}")
-    for k in redis.keys(f"error:{user}:*"): redis.delete(k)
-    for k in redis.keys(f"retry:{user}:*"): redis.delete(k)
+@app.post("/reset")
+def reset_system(user: str = Depends(get_current_user)):
+    # 與 compaction / reindex / 搬移共用 guard：這些工作依列號合併，執行中清空檔案會讓它們寫回錯亂的 index
+    held = []
+    try:
+        for kind in SNAPSHOT_KINDS:
+            guard = f"compaction:{kind}:{user}"
+            if not redis.set(guard, time.time(), nx=True, ex=300):
+                raise HTTPException(status_code=409, detail="Reindex, compaction or migration running; try again later")
+            held.append(guard)
+
+        # 只刪除該使用者的索引和元數據：先移除 manifest（讀取端立即看不到資料），再刪各版本檔案
+        for kind, lock_name in (("image", "write_lock"), ("pdf", "pdf_write_lock")):
+            with redis.lock(f"{lock_name}:{user}", timeout=10):
+                files = snapshot_files(user, kind)
+                manifest = read_manifest(user, kind) or {}
+                stale = [files["manifest"], files["log"], files["legacy_index"], files["legacy_meta"]]
+                stale += [os.path.join(files["root"], manifest[k]) for k in ("index", "metadata") if k in manifest]
+                stale += [os.path.join(files["root"], name) for name in manifest.get("previous", [])]
+                for path in stale:
+                    if os.path.exists(path):
+                        os.remove(path)
+
+        # 清除用戶專屬上傳目錄
+        root = user_root(user)
+        user_upload_dir = os.path.join(root, "uploads", user)
+        if os.path.exists(user_upload_dir): 
+            shutil.rmtree(user_upload_dir)
+            os.makedirs(user_upload_dir, exist_ok=True)
+
+        # 清除該使用者的縮圖 / 預覽圖
+        for variant in DERIVATIVE_VARIANTS:
+            user_derivative_dir = os.path.join(root, DERIVATIVE_SUBDIR, variant, "uploads", user)
+            if os.path.exists(user_derivative_dir):
+                shutil.rmtree(user_derivative_dir)
+
+        # 移除處理中任務的租約，避免之後被回收回已清空的佇列
+        leases = [f"{user}:{item}" for item in redis.smembers(f"{PROCESSING_SET_PREFIX}:{user}")]
+        if leases:
+            redis.zrem(LEASE_ZSET, *leases)
+            redis.hdel("processing_lanes", *leases)
+
+        # 清空使用者的佇列
+        redis.delete(*[queue_key(user, lane) for lane in QUEUE_LANES])
+        redis.delete(f"{PROCESSING_SET_PREFIX}:{user}", f"{DONE_SET_PREFIX}:{user}", f"enqueue_ts:{user}")
+        for k in redis.keys(f"error:{user}:*"): redis.delete(k)
+        for k in redis.keys(f"retry:{user}:*"): redis.delete(k)
+    finally:
+        if held:
+            redis.delete(*held)
 
     return {"message": f"Reset completed for user {user}."}
 
@@ -487,15 +1154,17 @@ def reset_system(user: str = Depends(get_current_user)):
 # 三個 SSE Endpoints
 @app.get("/status")
 async def status_sse(user: str = Depends(get_current_user)):
-    queue_key      = f"{QUEUE_PREFIX}:{user}"
+    queue_keys     = {lane: queue_key(user, lane) for lane in QUEUE_LANES}
     processing_key = f"{PROCESSING_SET_PREFIX}:{user}"
     done_key       = f"{DONE_SET_PREFIX}:{user}"
 
     async def event_generator():
         while True:
+            lanes = {lane: redis.lrange(key, 0, -1) for lane, key in queue_keys.items()}
             data = {
-                "queue":        redis.llen(queue_key),
-                "queued_items": redis.lrange(queue_key, 0, -1),
+                "queue":        sum(len(items) for items in lanes.values()),
+                "queued_items": [item for items in lanes.values() for item in items],
+                "queue_lanes":  {lane: len(items) for lane, items in lanes.items()},
                 "processing":   list(redis.smembers(processing_key)),
                 "processing_workers": {
                     item_key.split(":",1)[1]: worker
@@ -515,10 +1184,15 @@ async def worker_sse():
     async def event_generator():
         while True:
             raw = redis.hgetall("node_metrics")
+            age = backlog_age()
             status = {}
-            for w in WORKER_NAMES:
+            # worker 數量不固定（每台機器 fork 出多個子行程），以上線過的 worker 為準；
+            # 正常結束的 worker 會移除自己的 metrics，崩潰的則持續顯示為 dead
+            for w in sorted(redis.smembers("active_workers") | set(raw)):
                 if redis.exists(HEARTBEAT_PREFIX + w):
                     metrics = json.loads(raw.get(w, "{}"))
+                    # 佇列中最舊任務的等待秒數（全系統共用）放在每台 worker 的 metrics 旁
+                    metrics["backlog_age"] = age
                     status[w] = {"status": "health", "metrics": metrics}
                 else:
                     status[w] = {"status": "dead"}
@@ -526,25 +1200,153 @@ async def worker_sse():
             await asyncio.sleep(SSE_PUSH_INTERVAL)
     return StreamingResponse(event_generator(), media_type="text/event-stream")
 
+# 各 shard 的使用者數與 rebalance 狀態
+@app.get("/monitor/shards")
+def shard_status():
+    shards = {root: {"users": 0, "mounted": root_available(root)} for root in DATA_ROOTS}
+    pending = []
+    for user, root in redis.hgetall(USER_SHARD_HASH).items():
+        shards.setdefault(root, {"users": 0, "mounted": root_available(root)})["users"] += 1
+        if root != ring_shard(user):
+            pending.append(user)
+    return {
+        "shards": shards,
+        "pending": sorted(pending),
+        "migrating": sorted(k.split(":", 1)[1] for k in redis.scan_iter(f"{MIGRATING_PREFIX}:*")),
+        "rebalanced": redis.get(SHARD_CONFIG_KEY) == json.dumps(DATA_ROOTS),
+    }
+
+# 各 lane 的排隊時間百分位數，用來確認 interactive 的延遲目標
+@app.get("/monitor/queue")
+def queue_stats():
+    return lane_wait_stats()
+
+# Prometheus 格式的 metrics（worker 與 controller 都累加在 Redis）
+@app.get("/metrics")
+def metrics_endpoint():
+    return PlainTextResponse(render_prometheus(), media_type="text/plain; version=0.0.4")
+
 @app.get("/monitor/events")
-async def events_sse(limit: int = 50):
+async def events_sse(request: Request, limit: int = 50, last_event_id: Optional[str] = None):
+    """
+    第一次連線先送最近 limit 筆（新到舊），之後只送新事件
+    斷線重連時帶 Last-Event-ID header（或 last_event_id 參數）就從該位置接續
+    """
+    cursor = request.headers.get("last-event-id") or last_event_id
+
     async def event_generator():
-        while True:
-            items = redis.lrange(MONITOR_CHANNEL, 0, limit - 1)
-            evs = [json.loads(i) for i in items]
-            yield f"data: {json.dumps(evs)}\n\n"
-            await asyncio.sleep(SSE_PUSH_INTERVAL)
+        nonlocal cursor
+        if not cursor:
+            recent = await aredis.xrevrange(MONITOR_STREAM, count=limit)
+            cursor = recent[0][0] if recent else "0-0"
+            evs = [json.loads(fields["data"]) for _, fields in recent]
+            yield f"id: {cursor}\ndata: {json.dumps(evs)}\n\n"
+
+        while not await request.is_disconnected():
+            resp = await aredis.xread({MONITOR_STREAM: cursor}, count=limit, block=MONITOR_BLOCK_MS)
+            if not resp:
+                yield ": keepalive\n\n"
+                continue
+            entries = resp[0][1]
+            cursor = entries[-1][0]
+            evs = [json.loads(fields["data"]) for _, fields in reversed(entries)]
+            yield f"id: {cursor}\ndata: {json.dumps(evs)}\n\n"
     return StreamingResponse(event_generator(), media_type="text/event-stream")
 
 # delete 佇列中的項目
 @app.delete("/queue/{item:path}")
 def delete_queued_item(item: str, user: str = Depends(get_current_user)):
-    queue_key = f"{QUEUE_PREFIX}:{user}"
-    removed = redis.lrem(queue_key, 0, item)
+    removed = sum(redis.lrem(queue_key(user, lane), 0, item) for lane in QUEUE_LANES)
+    redis.hdel(f"enqueue_ts:{user}", item)
     if removed == 0:
         raise HTTPException(status_code=404, detail=f"Item {item} not found in queue")
     return {"message": f"Removed {removed} occurrence(s) of {item} from queue."}
 
+# 用已存的 caption 重建使用者的圖片索引（更換 embedding 模型後使用）
+@app.post("/reindex")
+def start_reindex(
+    model: Optional[str] = None,
+    index_type: Optional[str] = None,
+    metric: Optional[str] = None,
+    user: str = Depends(get_current_user)
+):
+    manifest = read_manifest(user, "image")
+    if manifest is None and not os.path.exists(snapshot_files(user, "image")["legacy_meta"]):
+        raise HTTPException(status_code=404, detail="Metadata or index not found")
+    # 沒指定的參數：模型用 controller 的 EMBED_MODEL，index 類型與距離沿用目前的 index
+    current = index_params(manifest or {})
+    params = {
+        "embed_model": model or EMBED_MODEL,
+        "index_type": index_type or current["index_type"],
+        "metric": metric or current["metric"],
+    }
+    if params["embed_model"] not in EMBED_MODELS:
+        raise HTTPException(status_code=400, detail=f"model must be one of {', '.join(EMBED_MODELS)}")
+    if params["index_type"] not in INDEX_TYPES:
+        raise HTTPException(status_code=400, detail=f"index_type must be one of {', '.join(INDEX_TYPES)}")
+    if params["metric"] not in INDEX_METRICS:
+        raise HTTPException(status_code=400, detail=f"metric must be one of {', '.join(INDEX_METRICS)}")
+    # 與 compaction 共用同一個 guard：重建期間列號不能被 compaction 改動
+    guard = f"compaction:image:{user}"
+    if not redis.set(guard, time.time(), nx=True, ex=3600):
+        raise HTTPException(status_code=409, detail="Reindex or compaction already running")
+
+    def run():
+        try:
+            reindex_user(user, params)
+        except Exception as e:
+            print(f"⚠️ Reindex failed for user {user}: {e}")
+            publish_reindex_progress(user, "failed", 0, 0, error=str(e))
+        finally:
+            redis.delete(guard)
+            recheck_compaction(user, "image")
+
+    threading.Thread(target=run, daemon=True).start()
+    return {"message": f"Reindex started for user {user}.", **params}
+
+@app.get("/reindex/status")
+def reindex_status(user: str = Depends(get_current_user)):
+    raw = redis.get(f"reindex_status:{user}")
+    if not raw:
+        raise HTTPException(status_code=404, detail="No reindex job found")
+    return json.loads(raw)
+
+# 刪除已建立索引的圖片：metadata 標記 tombstone，index 等背景 compaction 再重建
+@app.delete("/images/{item:path}")
+def delete_indexed_image(item: str, user: str = Depends(get_current_user)):
+    pdf_folder = os.path.normpath(f"uploads/{user}/pdfs")
+    norm_item = os.path.normpath(item)
+    if not norm_item.startswith(os.path.normpath(f"uploads/{user}") + os.sep):
+        raise HTTPException(status_code=403, detail="Item does not belong to current user")
+    kind = "pdf" if norm_item.startswith(pdf_folder) else "image"
+
+    try:
+        with timed_lock(f"{SNAPSHOT_LOCKS[kind]}:{user}") as lock:
+            index, metadata, manifest = load_snapshot(user, kind, replay=True)
+            hits = [m for m in metadata if m["filename"] == item and not m.get("deleted")]
+            if index is None or not hits:
+                raise HTTPException(status_code=404, detail=f"Item {item} not found in index")
+            for m in hits:
+                m["deleted"] = True
+            manifest = commit_snapshot(user, kind, index, metadata, manifest, lock=lock)
+    except SnapshotConflict as e:
+        raise HTTPException(status_code=409, detail=f"Index changed concurrently, retry: {e}")
+
+    # 移除原圖、衍生檔與 Redis 上的狀態
+    root = user_root(user)
+    full = os.path.join(root, item)
+    if os.path.isfile(full):
+        os.remove(full)
+    for variant in DERIVATIVE_VARIANTS:
+        derived = derivative_path(root, item, variant)
+        if os.path.isfile(derived):
+            os.remove(derived)
+    redis.srem(f"{DONE_SET_PREFIX}:{user}", item)
+    redis.delete(f"error:{user}:{item}", f"retry:{user}:{item}")
+
+    maybe_schedule_compaction(user, kind, manifest)
+    return {"message": f"Deleted {item}.", "tombstones": manifest["deleted"]}
+
 @app.get("/done")
 def list_done_images(user: str = Depends(get_current_user)):
     done_key = f"{DONE_SET_PREFIX}:{user}"
@@ -552,8 +1354,8 @@ def list_done_images(user: str = Depends(get_current_user)):
 
 @app.post("/monitor/events/reset")
 def reset_monitor_events():
-    if redis.exists(MONITOR_CHANNEL):
-        redis.delete(MONITOR_CHANNEL)
+    if redis.exists(MONITOR_STREAM, LEGACY_MONITOR_LIST):
+        redis.delete(MONITOR_STREAM, LEGACY_MONITOR_LIST)
         return {"message": "Monitor events reset successfully."}
     else:
         return {"message": "No monitor events to reset."}
@@ -563,21 +1365,18 @@ class AuthForm(BaseModel):
     password: str
 
 @app.post("/signup")
-def signup(form: AuthForm):
-    users = load_users()
-    if form.username in users:
+async def signup(form: AuthForm):
+    loop = asyncio.get_running_loop()
+    if not await loop.run_in_executor(AUTH_EXECUTOR, create_user, form.username, form.password):
         raise HTTPException(status_code=400, detail="User already exists")
-    users[form.username] = {"password": hash_password(form.password)}
-    save_users(users)
     # 同步新增 active_users set 讓 worker 能偵測到
     redis.sadd("active_users", form.username)
     return {"message": "Signup successful"}
 
 @app.post("/login")
-def login(form: OAuth2PasswordRequestForm = Depends()):
-    users = load_users()
-    u = users.get(form.username)
-    if not u or not verify_password(form.password, u["password"]):
+async def login(form: OAuth2PasswordRequestForm = Depends()):
+    loop = asyncio.get_running_loop()
+    if not await loop.run_in_executor(AUTH_EXECUTOR, authenticate, form.username, form.password):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
     # 確保登錄的用戶在 active_users 中
@@ -12,8 +12,11 @@ import {
   CircularProgress,
   Tooltip,
   Chip,
+  IconButton,
 } from '@mui/material';
-import { getImageUrl } from '../services/api';
+import { Delete as DeleteIcon } from '@mui/icons-material';
+import { useMutation } from '@tanstack/react-query';
+import { getImageUrl, deleteIndexedImage } from '../services/api';
 import useSSE from '../hooks/useSSE';
 
 function DoneSection() {
@@ -31,6 +34,20 @@ function DoneSection() {
     window.open(getImageUrl(item), '_blank');
   };
 
+  // 從索引中刪除（done 清單會由 /status SSE 自動更新）
+  const deleteMutation = useMutation({
+    mutationFn: deleteIndexedImage,
+    onError: (err) => {
+      window.alert(`Failed to delete image: ${err.response?.data?.detail || err.message}`);
+    },
+  });
+
+  const handleDelete = (item) => {
+    if (window.confirm(`Are you sure you want to delete "${item}" from your library?`)) {
+      deleteMutation.mutate(item);
+    }
+  };
+
   if (isLoading) {
     return (
       <Card id="done-section" sx={{ mb: 4 }}>
@@ -100,6 +117,21 @@ function DoneSection() {
             {doneItems.map((item, index) => (
               <React.Fragment key={`${item}-${index}`}>
                 <ListItem 
+                  secondaryAction={
+                    <Tooltip title="Delete from library">
+                      <IconButton
+                        edge="end"
+                        aria-label="delete"
+                        onClick={(e) => {
+                          e.stopPropagation();
+                          handleDelete(item);
+                        }}
+                        disabled={deleteMutation.isPending}
+                      >
+                        <DeleteIcon />
+                      </IconButton>
+                    </Tooltip>
+                  }
                   sx={{ 
                     cursor: 'pointer',
                     '&:hover': {
@@ -1,4 +1,4 @@
-import React, { useState } from 'react';
+import React, { useState, useEffect } from 'react';
 import {
   Card,
   CardContent,
@@ -15,18 +15,39 @@ import {
   Tooltip,
 } from '@mui/material';
 import RefreshIcon from '@mui/icons-material/Refresh';
-import useSSE from '../hooks/useSSE';
+import sseService from '../services/sseService';
 import { resetMonitorEvents } from '../services/api';
 
+// 保留在畫面上的事件數上限
+const MAX_EVENTS = 200;
+
 function EventMonitorSection() {
-  const { data, isLoading, error } = useSSE('monitorEvents', []);
+  const [events, setEvents] = useState([]);
+  const [isLoading, setIsLoading] = useState(true);
+  const [error, setError] = useState(null);
   const [resetting, setResetting] = useState(false);
 
+  // SSE 第一次送最近的事件，之後每次只送新事件（皆為新到舊）
+  // 直接在 listener 裡累積：同一次 render 前收到多批時，useSSE 的 data 只會留下最後一批
+  useEffect(() => {
+    setIsLoading(true);
+    setError(null);
+    const removeListener = sseService.addListener('monitorEvents', (batch) => {
+      if (batch && batch.length > 0) {
+        setEvents((prev) => [...batch, ...prev].slice(0, MAX_EVENTS));
+      }
+      setIsLoading(false);
+    });
+    return () => {
+      removeListener();
+    };
+  }, []);
+
   const handleReset = async () => {
     try {
       setResetting(true);
       await resetMonitorEvents();
-      // The SSE connection will automatically update with the new data
+      setEvents([]);
     } catch (error) {
       console.error('Error resetting monitor events:', error);
     } finally {
@@ -100,8 +121,6 @@ function EventMonitorSection() {
     );
   }
 
-  const events = data || [];
-
   return (
     <Card id="event-monitor-section" sx={{ mb: 4 }}>
       <CardHeader 
@@ -142,7 +161,7 @@ function EventMonitorSection() {
                       <Box sx={{ display: 'flex', alignItems: 'center', mb: 0.5 }}>
                         <Chip 
                           label={event.type} 
-                          color={event.type === 'worker_dead' ? 'error' : 'warning'} 
+                          color={['worker_dead', 'task_error'].includes(event.type) ? 'error' : event.type === 'task_done' ? 'success' : 'warning'} 
                           size="small" 
                           sx={{ mr: 1 }}
                         />
@@ -170,6 +189,13 @@ function EventMonitorSection() {
                             Task <strong>{event.item}</strong> timed out and was requeued
                           </Typography>
                         )}
+                        {!['worker_dead', 'task_timeout'].includes(event.type) && (
+                          <Typography variant="body2" component="span">
+                            {event.item ? <strong>{event.item}</strong> : null}
+                            {event.worker ? ` (${event.worker})` : ''}
+                            {event.error ? ` ${event.error}` : ''}
+                          </Typography>
+                        )}
                       </Box>
                     }
                   />
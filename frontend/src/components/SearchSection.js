@@ -213,7 +213,7 @@ export default function SearchSection() {
                   <CardMedia
                     component="img"
                     height="140"
-                    image={getImageUrl(path)}
+                    image={getImageUrl(path, 'thumb')}
                     alt={path}
                     sx={{ objectFit: 'cover' }}
                   />
@@ -438,7 +438,7 @@ export default function SearchSection() {
             <Box>
               <CardMedia
                 component="img"
-                image={getImageUrl(selectedImage.filename)}
+                image={getImageUrl(selectedImage.filename, 'preview')}
                 alt={selectedImage.filename}
                 sx={{
                   width: '100%',
@@ -123,6 +123,12 @@ function WorkerHealthSection() {
                         </Typography>
                       )}
                     </Box>
+
+                    {isHealthy && metrics.throughput !== undefined && (
+                      <Typography variant="caption" color="text.secondary" sx={{ display: 'block', mb: 0.5 }}>
+                        {metrics.throughput.toFixed(2)} img/s · Backlog age: {Math.round(metrics.backlog_age || 0)}s
+                      </Typography>
+                    )}
                     
                     {isHealthy && metrics && (
                       <Box sx={{ height: 'calc(100% - 30px)' }}>
@@ -196,7 +196,7 @@ function PdfSearchPage() {
                     component="img"
                     alt={`Page from ${results.top_result.filename}`}
                     height="600"
-                    image={getImageUrl(results.top_result.filename)}
+                    image={getImageUrl(results.top_result.filename, 'preview')}
                       sx={{
                         objectFit: 'contain',
                         borderBottom: '1px solid #eee',
@@ -121,6 +121,12 @@ export const deleteQueueItem = async (item) => {
   return response.data;
 };
 
+// 刪除已建立索引的影像
+export const deleteIndexedImage = async (item) => {
+  const response = await api.delete(`/images/${item}`);
+  return response.data;
+};
+
 // 取得 Worker 狀態
 export const getWorkerStatus = async () => {
   const response = await api.get('/monitor/worker');
@@ -166,9 +172,10 @@ export const searchImages = async (query, imageFile, topK = 5) => {
   }
 };
 
-// 取得影像路徑 URL
-export const getImageUrl = (path) => {
-  return `${api.defaults.baseURL}image/${path}`;
+// 取得影像路徑 URL，variant 可為 'thumb' / 'preview'，省略則為原圖
+export const getImageUrl = (path, variant) => {
+  const url = `${api.defaults.baseURL}image/${path}`;
+  return variant ? `${url}?variant=${variant}` : url;
 };
 
 // 重置系統
@@ -203,6 +210,7 @@ const apiService = {
   uploadPdfOrZip,
   getStatus,
   deleteQueueItem,
+  deleteIndexedImage,
   getWorkerStatus,
   getMonitorEvents,
   searchImages,
@@ -7,6 +7,8 @@ const API_URL = 'http://localhost:8000';  // 後端地址
 class SSEService {
   constructor() {
     this.eventSources = {};
+    // 每種連線最後收到的事件 id，重連時以 Last-Event-ID 接續
+    this.lastEventIds = {};
     this.listeners = { status: [], workerStatus: [], monitorEvents: [] };
   }
 
@@ -27,12 +29,19 @@ class SSEService {
 
     // 用 polyfill 版本的 EventSource
     const url = `${API_URL}${endpoint}`;
+    const headers = { Authorization: `${tokenType} ${token}` };
+    if (this.lastEventIds[type]) {
+      headers['Last-Event-ID'] = this.lastEventIds[type];
+    }
     const es = new EventSourcePolyfill(url, {
-      headers: { Authorization: `${tokenType} ${token}` },
+      headers,
       heartbeatTimeout: 45000,
     });
 
     es.onmessage = (e) => {
+      if (e.lastEventId) {
+        this.lastEventIds[type] = e.lastEventId;
+      }
       try {
         const data = JSON.parse(e.data);
         console.log(`📡 [SSE:${type}] Data received:`, {
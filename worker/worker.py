@@ -1,4 +1,4 @@
-import os, time, json, traceback, atexit
+import os, sys, gc, time, json, signal, traceback, atexit
 from threading import Thread
 import psutil
 from redis import Redis
@@ -6,7 +6,6 @@ from PIL import Image
 import numpy as np
 from sentence_transformers import SentenceTransformer
 from transformers import BlipProcessor, BlipForConditionalGeneration
-import faiss
 import torch
 from pillow_heif import register_heif_opener
 import piexif
@@ -19,17 +18,51 @@ import random
 from dotenv import load_dotenv
 load_dotenv()
 
+from common import context
+from common.metrics import inc_counter, observe, timed
+from common.shards import DATA_ROOTS, MIGRATING_PREFIX, USER_SHARD_HASH, ring_shard, user_root
+from common.snapshot import (
+    EMBED_MODELS, SnapshotConflict, append_log, atomic_write_bytes, checkpoint_due, checkpoint_snapshot, index_params, read_manifest,
+    timed_lock,
+)
+
 # 讀取 Worker 名稱
 WORKER_NAME = os.getenv("WORKER_NAME", "unknown")
+SERVICE_NAME = WORKER_NAME
 
 # 資料目錄與 Redis key 設定
-UPLOAD_DIR = "/data/uploads"
+DATA_DIR = os.getenv("DATA_DIR", "/data")
+UPLOAD_DIR = os.path.join(DATA_DIR, "uploads")
+REDIS_HOST = os.getenv("REDIS_HOST", "redis")
+
+# 分片儲存（DATA_ROOTS 與 hash ring 見 common/shards.py）
+# 這台 worker 本機的 root，領任務時優先挑資料在本機的使用者
+LOCAL_SHARDS = set(r.strip() for r in os.getenv("LOCAL_SHARDS", ",".join(DATA_ROOTS)).split(",") if r.strip())
 
 # 將單一queue換成prefix
 QUEUE_PREFIX = "image_queue"
+# 優先權 lane：interactive 給少量的互動上傳、bulk 給大批匯入，normal 沿用原本的 image_queue:{user}
+QUEUE_LANES = ("interactive", "normal", "bulk")
+DEFAULT_LANE = "normal"
+# lane 的排程權重：三個 lane 都有任務時大約以 8:3:1 的比例取出，只剩 bulk 時 bulk 吃滿全部產能
+LANE_WEIGHTS = {"interactive": 8, "normal": 3, "bulk": 1}
+# 每個 tenant 的 token bucket（任務/秒、可累積上限），所有 worker 共用同一個 bucket
+TENANT_RATE = float(os.getenv("TENANT_RATE", "2"))
+TENANT_BURST = float(os.getenv("TENANT_BURST", "20"))
+QUOTA_PREFIX = "quota"
 PROCESSING_SET_PREFIX = "processing_set"
 DONE_SET_PREFIX = "done_set"
 
+# 監控事件 stream（與 controller 相同）
+MONITOR_STREAM = "monitor_stream"
+MONITOR_STREAM_MAXLEN = 10000
+
+# 任務租約：score 為到期時間，controller 只需 ZRANGEBYSCORE 就能找到逾時的任務
+# 處理中的任務由心跳 thread 持續續約，只有 worker 停止續約（卡死或崩潰）超過 PROCESSING_TIMEOUT 才會被回收
+LEASE_ZSET = "processing_leases"
+WORKER_TASKS_PREFIX = "worker_tasks"
+PROCESSING_TIMEOUT = 30
+
 # Metrics Hash 名稱
 METRICS_HASH = "node_metrics"
 
@@ -37,6 +70,17 @@ HEARTBEAT_KEY     = f"heartbeat:{WORKER_NAME}"
 HEARTBEAT_EXPIRE  = 5    # 心跳 key 過期時間 (秒)
 HEARTBEAT_INTERVAL= 1     # 心跳更新間隔 (秒)
 
+# 縮圖 / 預覽圖等衍生檔設定：{root}/derivatives/{variant}/{原路徑去副檔名}.webp
+DERIVATIVE_SUBDIR = "derivatives"
+DERIVATIVE_VARIANTS = {
+    "thumb":   {"max_side": 320,  "quality": 75},
+    "preview": {"max_side": 1280, "quality": 82},
+}
+
+# 前處理設定：BLIP 輸入尺寸與送 Cohere 的 PDF 頁面最長邊
+INFERENCE_SIZE = 384
+PDF_EMBED_MAX_SIDE = 1568
+
 register_heif_opener()
 geolocator = Nominatim(user_agent="image-rag")
 
@@ -49,339 +93,690 @@ def dms_to_decimal(dms, ref):
         decimal *= -1
     return round(decimal, 6)
 
+def derivative_path(root, rel_path, variant):
+    base = os.path.splitext(rel_path)[0]
+    return os.path.join(root, DERIVATIVE_SUBDIR, variant, base + ".webp")
+
+def downscale(image, max_side):
+    """等比例縮小到最長邊不超過 max_side（不會放大），回傳新圖"""
+    img = image.copy()
+    img.thumbnail((max_side, max_side), Image.LANCZOS, reducing_gap=3.0)
+    return img
+
+def preprocess_image(full_path, is_heic=False, is_pdf_page=False):
+    """
+    單次解碼圖片：
+    - EXIF 直接從檔頭讀取（img.info），不需要解碼像素
+    - JPEG 透過 draft() 以 DCT 縮放直接解碼到需要的解析度
+    - HEIC 需要整張轉成 JPG，因此完整解碼一次並重複使用
+    回傳 image（後續縮圖 / 轉檔 / Cohere 用）與 inference（BLIP 輸入）
+    """
+    img = Image.open(full_path)
+    exif_bytes = img.info.get("exif")
+
+    if not is_heic:
+        target = PDF_EMBED_MAX_SIDE if is_pdf_page else max(v["max_side"] for v in DERIVATIVE_VARIANTS.values())
+        img.draft("RGB", (target, target))
+    image = img.convert("RGB")
+
+    # BLIP processor 本身就會 resize 成 384x384，這裡直接縮好避免它處理整張原圖
+    inference = None
+    if not is_pdf_page:
+        inference = image.resize((INFERENCE_SIZE, INFERENCE_SIZE), Image.BICUBIC, reducing_gap=3.0)
+
+    return {"image": image, "inference": inference, "exif": exif_bytes}
+
+def extract_exif_fields(exif_bytes):
+    """從 EXIF 取出拍攝日期，並用 GPS 反查國家 / 城市"""
+    country = None
+    city = None
+    date_str = None
+    exif_dict = piexif.load(exif_bytes)
+
+    # 時間
+    date_bytes = exif_dict.get("Exif", {}).get(piexif.ExifIFD.DateTimeOriginal)
+    if date_bytes:
+        date_str = date_bytes.decode(errors="ignore").split(" ")[0].replace(":", "-")
+
+    # GPS
+    gps = exif_dict.get("GPS", {})
+    lat = gps.get(piexif.GPSIFD.GPSLatitude)
+    lat_ref = gps.get(piexif.GPSIFD.GPSLatitudeRef)
+    lon = gps.get(piexif.GPSIFD.GPSLongitude)
+    lon_ref = gps.get(piexif.GPSIFD.GPSLongitudeRef)
+
+    if lat and lat_ref and lon and lon_ref:
+        lat_decimal = dms_to_decimal(lat, lat_ref)
+        lon_decimal = dms_to_decimal(lon, lon_ref)
+        location = geolocator.reverse((lat_decimal, lon_decimal), language="en", timeout=10)
+        if location and "address" in location.raw:
+            addr = location.raw["address"]
+            country = addr.get("country")
+            city = addr.get("city", addr.get("town", addr.get("village")))
+
+    return date_str, country, city
+
+def embedding_text(entry):
+    """由 metadata 組出要 embed 的文字；controller 重建索引時用同一個格式"""
+    return f"{entry['caption']}. Location: {entry.get('city')}, {entry.get('country')}. Date: {entry.get('date') or ''}."
+
+def make_derivatives(image, root, rel_path):
+    """
+    依 DERIVATIVE_VARIANTS 產生縮圖與預覽圖（WebP）
+    controller 可能同時在補產生同一個檔案：各自寫唯一的暫存檔再 rename，不會讀到或發布半個檔案
+    """
+    for variant, spec in DERIVATIVE_VARIANTS.items():
+        out_path = derivative_path(root, rel_path, variant)
+        os.makedirs(os.path.dirname(out_path), exist_ok=True)
+        buf = BytesIO()
+        downscale(image, spec["max_side"]).save(buf, "WEBP", quality=spec["quality"], method=4)
+        atomic_write_bytes(out_path, buf.getvalue())
+
 # 連線 Redis
-redis = Redis(host="redis", port=6379, decode_responses=True)
+redis = Redis(host=REDIS_HOST, port=6379, decode_responses=True)
+context.configure(redis, SERVICE_NAME)
+
+def publish_event(event_type, **fields):
+    """寫入監控事件 stream，失敗不影響任務處理"""
+    event = {"ts": time.time(), "type": event_type, **fields}
+    try:
+        redis.xadd(MONITOR_STREAM, {"data": json.dumps(event)}, maxlen=MONITOR_STREAM_MAXLEN, approximate=True)
+    except Exception as e:
+        print(f"⚠️ Failed to publish event {event_type}: {e}")
+
+def queue_key(user, lane=DEFAULT_LANE):
+    if lane == DEFAULT_LANE:
+        return f"{QUEUE_PREFIX}:{user}"
+    return f"{QUEUE_PREFIX}:{user}:{lane}"
+
+def mark_processing(user, image_path, now=None, lane=DEFAULT_LANE):
+    """標記任務處理中：processing_ts / processing_set / processing_workers / lane 與租約一次寫入"""
+    now = now or time.time()
+    member = f"{user}:{image_path}"
+    pipe = redis.pipeline()
+    pipe.set(f"processing_ts:{member}", now)
+    pipe.sadd(f"{PROCESSING_SET_PREFIX}:{user}", image_path)
+    pipe.hset("processing_workers", member, WORKER_NAME)
+    pipe.hset("processing_lanes", member, lane)
+    pipe.sadd(f"{WORKER_TASKS_PREFIX}:{WORKER_NAME}", member)
+    pipe.zadd(LEASE_ZSET, {member: now + PROCESSING_TIMEOUT})
+    pipe.execute()
+
+# 只清掉自己的標記：租約被回收、任務已由其他 worker 重新領取時，不能刪掉對方的 processing 狀態
+CLEAR_PROCESSING_LUA = """
+local owner = redis.call('HGET', 'processing_workers', ARGV[1])
+redis.call('SREM', KEYS[1], ARGV[1])
+if owner and owner ~= ARGV[2] then
+    return 0
+end
+redis.call('DEL', 'processing_ts:' .. ARGV[1])
+redis.call('SREM', KEYS[2], ARGV[3])
+redis.call('HDEL', 'processing_workers', ARGV[1])
+redis.call('HDEL', 'processing_lanes', ARGV[1])
+redis.call('ZREM', KEYS[3], ARGV[1])
+return 1
+"""
+
+def clear_processing(user, image_path):
+    member = f"{user}:{image_path}"
+    redis.eval(CLEAR_PROCESSING_LUA, 3, f"{WORKER_TASKS_PREFIX}:{WORKER_NAME}",
+               f"{PROCESSING_SET_PREFIX}:{user}", LEASE_ZSET, member, WORKER_NAME, image_path)
+
+def renew_leases():
+    """處理中的任務續約；XX：已被 controller 回收的租約不會被加回來"""
+    members = redis.smembers(f"{WORKER_TASKS_PREFIX}:{WORKER_NAME}")
+    if members:
+        deadline = time.time() + PROCESSING_TIMEOUT
+        redis.zadd(LEASE_ZSET, {m: deadline for m in members}, xx=True)
+
+# 已完成的任務數，publish_metrics 依此計算吞吐量（images/sec）
+processed_count = 0
 
 # 將自己註冊到 active_workers set 裡，監控程式可用來知道哪些節點上線
-redis.sadd("active_workers", WORKER_NAME)
-# 重新開機就馬上送出第一顆心跳
-redis.set(HEARTBEAT_KEY, time.time(), ex=HEARTBEAT_EXPIRE)
+def register_worker():
+    redis.sadd("active_workers", WORKER_NAME)
+    # 重新開機就馬上送出第一顆心跳
+    redis.set(HEARTBEAT_KEY, time.time(), ex=HEARTBEAT_EXPIRE)
+    publish_event("worker_join", worker=WORKER_NAME)
+    atexit.register(on_exit)
+
+    # 啟動背景thread
+    Thread(target=publish_heartbeat, daemon=True).start()
+    Thread(target=publish_metrics, daemon=True).start()
 
 def on_exit():
     redis.srem("active_workers", WORKER_NAME)
-atexit.register(on_exit)
+    redis.hdel(METRICS_HASH, WORKER_NAME)
+    publish_event("worker_leave", worker=WORKER_NAME)
 
 def publish_heartbeat():
     while True:
-        # 每 HEARTBEAT_INTERVAL 秒更新一次，並設定自動過期
-        redis.set(HEARTBEAT_KEY, time.time(), ex=HEARTBEAT_EXPIRE)
+        # 每 HEARTBEAT_INTERVAL 秒更新一次，並設定自動過期；同時替手上的任務續約
+        try:
+            redis.set(HEARTBEAT_KEY, time.time(), ex=HEARTBEAT_EXPIRE)
+            renew_leases()
+        except Exception as e:
+            print(f"⚠️ Failed to publish heartbeat: {e}")
         time.sleep(HEARTBEAT_INTERVAL)
 
 # Metrics 上報：定期將 CPU% 與 Memory% 寫入 Redis hash
 def publish_metrics():
+    last_count, last_ts = processed_count, time.time()
     while True:
         # psutil.cpu_percent(interval=1) 會阻塞 1 秒採樣
         cpu = psutil.cpu_percent(interval=1)
         mem = psutil.virtual_memory().percent
         timestamp = time.time()
-        data = {"cpu": cpu, "mem": mem, "ts": timestamp}
+        # 與上一次上報之間完成的張數
+        throughput = (processed_count - last_count) / max(timestamp - last_ts, 1e-6)
+        last_count, last_ts = processed_count, timestamp
+        data = {"cpu": cpu, "mem": mem, "throughput": round(throughput, 3), "ts": timestamp}
         try:
             redis.hset(METRICS_HASH, WORKER_NAME, json.dumps(data))
         except Exception:
             print(f"⚠️ Failed to publish metrics: {traceback.format_exc()}")
         time.sleep(2)  # 剩餘時間睡眠
 
-# 啟動背景thread
-Thread(target=publish_heartbeat, daemon=True).start()
-Thread(target=publish_metrics, daemon=True).start()
-
-device = "cuda" if torch.cuda.is_available() else "cpu"
 # 模型載入
-COHERE_API_KEY = os.getenv("COHERE_API_KEY")
-co = cohere.ClientV2(api_key=COHERE_API_KEY)
-
-caption_processor = BlipProcessor.from_pretrained("Salesforce/blip-image-captioning-base")
-caption_model = BlipForConditionalGeneration.from_pretrained("Salesforce/blip-image-captioning-base").to(device)
-embedder = SentenceTransformer("all-MiniLM-L6-v2")
-
-# 載入 metadata 和 index
-# 不需要預先載入全域metadata和index
-print(f"Worker '{WORKER_NAME}' started on {device} device")
-
-# 不停循環從 redis 的 image_queue 拿任務出來做
-while True:
-    try:
-        # 1) 先從 Redis 拿出所有 active_users
-        user_ids = list(redis.smembers("active_users"))
-        # 2) 計算每個 user 的隊列長度
-        lengths = []
-        total = 0
-        for u in user_ids:
-            l = redis.llen(f"{QUEUE_PREFIX}:{u}")
-            if l > 0:
-                lengths.append((u, l))
-                total += l
-        # 如果沒有任何任務，sleep 然後繼續
-        if total == 0:
-            time.sleep(0.1)
-            continue
-
-        # 3) 按 length 加權隨機選一個 user
-        #    （隊列越長被選中的機率越大）
-        r = random.uniform(0, total)
+def load_models():
+    global device, co, caption_processor, caption_model
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    COHERE_API_KEY = os.getenv("COHERE_API_KEY")
+    co = cohere.ClientV2(api_key=COHERE_API_KEY)
+
+    caption_processor = BlipProcessor.from_pretrained("Salesforce/blip-image-captioning-base")
+    caption_model = BlipForConditionalGeneration.from_pretrained("Salesforce/blip-image-captioning-base").to(device)
+    for model in EMBED_MODELS:
+        embedders[model] = SentenceTransformer(model)
+
+# 依模型名稱快取：EMBED_MODELS 全部在 fork 前載入，子行程共用同一份權重
+embedders = {}
+
+def get_embedder(model):
+    if model not in embedders:
+        raise ValueError(f"Embedding model {model} is not in EMBED_MODELS")
+    return embedders[model]
+
+def encode_text(text, params):
+    """用 manifest 指定的模型 embed；inner product 時先正規化，與 controller 的查詢向量一致"""
+    vec = get_embedder(params["embed_model"]).encode(text, normalize_embeddings=params["metric"] == "ip")
+    return np.asarray(vec, dtype=np.float32)
+
+# token bucket：依經過時間補 token，夠 1 個就扣掉並回傳 1
+TOKEN_BUCKET_LUA = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or burst
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return allowed
+"""
+
+def take_token(user):
+    return bool(redis.eval(TOKEN_BUCKET_LUA, 1, f"{QUOTA_PREFIX}:{user}", TENANT_RATE, TENANT_BURST, time.time()))
+
+def lane_order(lanes):
+    """依 LANE_WEIGHTS 做加權隨機排序（權重越大越常排在前面）"""
+    remaining = list(lanes)
+    order = []
+    while remaining:
+        r = random.uniform(0, sum(LANE_WEIGHTS[l] for l in remaining))
         upto = 0
-        for (u, l) in lengths:
-            upto += l
+        for lane in remaining:
+            upto += LANE_WEIGHTS[lane]
             if upto >= r:
-                selected_user = u
                 break
-
-        queue_key = f"{QUEUE_PREFIX}:{selected_user}"
-        image_path = redis.rpop(queue_key)
-        if not image_path:
-            # 這個極少發生，重試一下
-            continue
-
-        # --- 拿到一條真正要處理的任務，下面沿用你現有的邏輯，只是把 `user` 換成 selected_user ---
-        user = selected_user
-        start_time = time.time()
-        orig_image_path = image_path  # <== 新增：記住原來的路徑
-        redis.set(f"processing_ts:{user}:{image_path}", start_time)
-        
-        print(f"🔄 Processing image: {image_path} for user {user} by {WORKER_NAME}")
-
-        # 標記處理中並記錄是哪一台
-        redis.sadd(f"{PROCESSING_SET_PREFIX}:{user}", image_path)
-        redis.hset("processing_workers", f"{user}:{image_path}", WORKER_NAME)
-        
-        # 使用者特定的路徑
-        user_meta = f"/data/metadata_{user}.json"
-        user_index = f"/data/index_file_{user}.index"
-        user_pdf_index = f"/data/pdf_index_{user}.index"
-        user_pdf_meta = f"/data/pdf_metadata_{user}.json"
-        
-        full_path = os.path.join("/data", image_path)
-        try:
-            if not os.path.exists(full_path) or not os.path.isfile(full_path):
-                raise FileNotFoundError(f"File not found: {full_path}")
-
-            # 開啟圖片
-            image = Image.open(full_path).convert("RGB")
-
-            # 動態判斷：是不是上傳到 uploads/{user}/pdfs 下的檔案
-            pdf_folder = f"uploads/{user}/pdfs"
-            # 把兩邊都標準化一下再比
-            norm_image = os.path.normpath(image_path)
-            norm_folder = os.path.normpath(pdf_folder)
-            print(f"[DEBUG] user={user} pdf_folder={norm_folder} image_path={norm_image}")
-            is_pdf_page = norm_image.startswith(norm_folder)
-
-            if is_pdf_page:
-                print(f"📄 Processing PDF image with Cohere: {image_path}")
-
-                # 轉成 base64 URL
-                buf = BytesIO()
-                image.save(buf, format="JPEG")
-                b64 = base64.b64encode(buf.getvalue()).decode("utf-8")
-                b64_url = f"data:image/jpeg;base64,{b64}"
-
-                image_input = {
-                    "content": [
-                        {"type": "image_url", "image_url": {"url": b64_url}}
-                    ]
-                }
-
-                try:
+        order.append(lane)
+        remaining.remove(lane)
+    return order
+
+def claim_task():
+    """
+    從 redis 的 image_queue 挑一筆任務，沒有任務時回傳 None
+    1) lane 依權重挑選，interactive 優先、bulk 只在其他 lane 空閒時吃滿產能
+    2) 同一個 lane 裡的 user 均等隨機（不再依隊列長度加權，資料在本機 shard 的優先），並須通過 token bucket
+    3) 所有有任務的 user 都超過配額時不讓 worker 閒置，照 lane 順序直接取
+    """
+    # 1) 先從 Redis 拿出所有 active_users，一次查出每個 lane 的隊列長度
+    user_ids = list(redis.smembers("active_users"))
+    pipe = redis.pipeline(transaction=False)
+    for u in user_ids:
+        pipe.exists(f"{MIGRATING_PREFIX}:{u}")
+        pipe.hget(USER_SHARD_HASH, u)
+    flags = pipe.execute()
+    # 搬移到其他 shard 中的使用者先不領取
+    migrating = {u for u, busy in zip(user_ids, flags[0::2]) if busy}
+    local = {u for u, root in zip(user_ids, flags[1::2]) if (root or ring_shard(u)) in LOCAL_SHARDS}
+    user_ids = [u for u in user_ids if u not in migrating]
+
+    pipe = redis.pipeline(transaction=False)
+    for u in user_ids:
+        for lane in QUEUE_LANES:
+            pipe.llen(queue_key(u, lane))
+    lengths = iter(pipe.execute())
+    waiting = {lane: [] for lane in QUEUE_LANES}
+    for u in user_ids:
+        for lane in QUEUE_LANES:
+            if next(lengths) > 0:
+                waiting[lane].append(u)
+    lanes = [lane for lane in QUEUE_LANES if waiting[lane]]
+    if not lanes:
+        return None
+
+    # 2) 加權挑 lane，lane 內隨機挑一個還有配額的 user
+    order = lane_order(lanes)
+    selected = None
+    for lane in order:
+        random.shuffle(waiting[lane])
+        # 資料在本機 shard 的使用者排在前面
+        waiting[lane].sort(key=lambda u: u not in local)
+        selected = next(((u, lane) for u in waiting[lane] if take_token(u)), None)
+        if selected:
+            break
+    if selected is None:
+        inc_counter("quota_throttled_total", worker=WORKER_NAME)
+        selected = (waiting[order[0]][0], order[0])
+
+    selected_user, lane = selected
+    image_path = redis.rpop(queue_key(selected_user, lane))
+    if not image_path:
+        # 這個極少發生，下一輪再試
+        return None
+    return selected_user, image_path, lane
+
+def write_snapshot_entry(user, kind, lock_name, entry, embed):
+    """
+    持寫入鎖把一筆資料 append 到 log（fsync 後即 durable，查詢端會重播 log 的尾端），
+    不必每張圖都重寫整份 snapshot；累積到 checkpoint 門檻時才把 log 併進新版本
+    同一個檔案重複 append（崩潰後重新派發的任務）時，重播 log 只會保留一筆
+    embed(params) 回傳向量：在取得鎖之前先依目前 manifest 的參數算好，縮短持有鎖的時間；
+    拿到鎖後若 reindex 已切換模型或距離，就以新的參數重算
+    """
+    params = index_params(read_manifest(user, kind) or {})
+    vector = embed(params)
+    with timed_lock(f"{lock_name}:{user}") as lock:
+        manifest = read_manifest(user, kind)
+        if index_params(manifest or {}) != params:
+            params = index_params(manifest or {})
+            vector = embed(params)
+        with timed("log_append"):
+            pending = append_log(user, kind, manifest, entry, vector, lock=lock)
+        if checkpoint_due(manifest, pending):
+            try:
+                with timed("index_write"):
+                    checkpoint_snapshot(user, kind, lock=lock)
+            except SnapshotConflict as e:
+                # 項目已經在 log 裡，下一次寫入時再 checkpoint
+                print(f"⚠️ Checkpoint skipped: {e}")
+
+def process_task(user, image_path, lane=DEFAULT_LANE):
+    """處理一筆任務：caption / embedding 後寫入使用者的 index，失敗時記錄 error 並重試一次"""
+    global processed_count
+    start_time = time.time()
+    orig_image_path = image_path  # <== 新增：記住原來的路徑
+
+    # enqueue → claim 的等待時間
+    enqueued_at = redis.hget(f"enqueue_ts:{user}", image_path)
+    redis.hdel(f"enqueue_ts:{user}", image_path)
+    if enqueued_at:
+        observe("queue_wait_seconds", start_time - float(enqueued_at), lane=lane, service=SERVICE_NAME)
+
+    print(f"🔄 Processing image: {image_path} for user {user} by {WORKER_NAME}")
+
+    # 標記處理中、記錄是哪一台並取得租約
+    mark_processing(user, image_path, start_time, lane)
+
+    # 標記之後再確認一次：搬移開始時 controller 會等 processing_set 清空，這裡退回就不會寫到舊的 root
+    if redis.exists(f"{MIGRATING_PREFIX}:{user}"):
+        clear_processing(user, image_path)
+        redis.hset(f"enqueue_ts:{user}", image_path, enqueued_at or start_time)
+        redis.rpush(queue_key(user, lane), image_path)
+        return
+
+    root = user_root(user)
+    full_path = os.path.join(root, image_path)
+    try:
+        if not os.path.exists(full_path) or not os.path.isfile(full_path):
+            raise FileNotFoundError(f"File not found: {full_path}")
+
+        # 動態判斷：是不是上傳到 uploads/{user}/pdfs 下的檔案
+        pdf_folder = f"uploads/{user}/pdfs"
+        # 把兩邊都標準化一下再比
+        norm_image = os.path.normpath(image_path)
+        norm_folder = os.path.normpath(pdf_folder)
+        print(f"[DEBUG] user={user} pdf_folder={norm_folder} image_path={norm_image}")
+        is_pdf_page = norm_image.startswith(norm_folder)
+        is_heic = image_path.lower().endswith(".heic")
+
+        # 每個檔案只解碼一次，caption / HEIC 轉檔 / Cohere / 縮圖都共用這份
+        with timed("decode"):
+            prep = preprocess_image(full_path, is_heic=is_heic, is_pdf_page=is_pdf_page)
+        image = prep["image"]
+
+        if is_pdf_page:
+            print(f"📄 Processing PDF image with Cohere: {image_path}")
+
+            # 縮到 Cohere 需要的尺寸再轉成 base64 URL
+            page = downscale(image, PDF_EMBED_MAX_SIDE)
+            buf = BytesIO()
+            page.save(buf, format="JPEG", quality=85)
+            b64 = base64.b64encode(buf.getvalue()).decode("utf-8")
+            b64_url = f"data:image/jpeg;base64,{b64}"
+
+            image_input = {
+                "content": [
+                    {"type": "image_url", "image_url": {"url": b64_url}}
+                ]
+            }
+
+            try:
+                with timed("cohere"):
                     res = co.embed(
                         model="embed-v4.0",
                         inputs=[image_input],
                         input_type="search_document",
                         embedding_types=["float"]
                     )
-                    vector = np.array(res.embeddings.float_[0], dtype=np.float32)
-
-                    with redis.lock(f"pdf_write_lock:{user}", timeout=10):
-                        if os.path.exists(user_pdf_index):
-                            pdf_index = faiss.read_index(user_pdf_index)
-                        else:
-                            pdf_index = faiss.IndexFlatL2(len(vector))
+                vector = np.array(res.embeddings.float_[0], dtype=np.float32)
 
-                        if os.path.exists(user_pdf_meta):
-                            with open(user_pdf_meta, "r", encoding="utf-8") as f:
-                                pdf_meta = json.load(f)
-                        else:
-                            pdf_meta = []
+                # 衍生檔在寫入索引之前產生：項目一出現在搜尋結果，縮圖就已經存在
+                try:
+                    with timed("derivatives"):
+                        make_derivatives(image, root, image_path)
+                except Exception as e:
+                    print(f"⚠️ Derivative generation failed for {image_path}: {e}")
 
-                        pdf_index.add(np.array([vector]))
-                        faiss.write_index(pdf_index, user_pdf_index)
+                pdf_entry = {"filename": image_path}
+                # PDF 固定用 Cohere 的向量，與 manifest 的 embedding 模型無關
+                write_snapshot_entry(user, "pdf", "pdf_write_lock", pdf_entry, lambda params: vector)
 
-                        pdf_meta.append({"filename": image_path})
-                        json.dump(pdf_meta, open(user_pdf_meta, "w", encoding="utf-8"), ensure_ascii=False, indent=2)
+                # 標記完成
+                clear_processing(user, orig_image_path)
+                redis.sadd(f"{DONE_SET_PREFIX}:{user}", orig_image_path)
 
-                    # 標記完成
-                    redis.delete(f"processing_ts:{user}:{orig_image_path}")
-                    redis.srem(f"{PROCESSING_SET_PREFIX}:{user}", orig_image_path)
-                    redis.hdel("processing_workers", f"{user}:{orig_image_path}")
-                    redis.sadd(f"{DONE_SET_PREFIX}:{user}", orig_image_path)
+                processed_count += 1
+                inc_counter("images_processed_total", worker=WORKER_NAME, kind="pdf")
+                observe("task_seconds", time.time() - start_time, kind="pdf", service=SERVICE_NAME)
+                publish_event("task_done", user=user, item=orig_image_path, worker=WORKER_NAME, kind="pdf",
+                              seconds=round(time.time() - start_time, 3))
+                print(f"✅ {WORKER_NAME} done {image_path} for user {user} with Cohere embedding")
 
-                    print(f"✅ {WORKER_NAME} done {image_path} for user {user} with Cohere embedding")
+                return  # ❗️這一點很重要，跳過預設 BLIP 處理
 
-                    continue  # ❗️這一點很重要，跳過預設 BLIP 處理
+            except Exception as e:
+                print(f"❌ Cohere embedding failed for {image_path}: {e}")
+                raise e
 
-                except Exception as e:
-                    print(f"❌ Cohere embedding failed for {image_path}: {e}")
-                    raise e
-
-            # 用 BLIP 生 caption
-            inputs = caption_processor(image, return_tensors="pt").to(device)
+        # 用 BLIP 生 caption（輸入已是 384x384，processor 不需再縮放整張原圖）
+        with timed("blip"):
+            inputs = caption_processor(prep["inference"], return_tensors="pt").to(device)
             out = caption_model.generate(**inputs, max_length=50)
             caption = caption_processor.decode(out[0], skip_special_tokens=True)
 
-            # 加鎖寫 metadata 和 FAISS
-            with redis.lock(f"write_lock:{user}", timeout=10):
-                """
-                worker 拿到鎖之後
-                馬上讀「現在最新磁碟上的 metadata.json、index」
-                基於最新版本去加自己的新資料
-                以免覆蓋掉其他 worker 的資料
-                """
-                # 讀使用者的 metadata
-                if os.path.exists(user_meta):
-                    metadata = json.load(open(user_meta, "r", encoding="utf-8"))
+        # 預設欄位
+        country = None
+        city = None
+        date_str = None
+
+        # 若為 HEIC，先提取 metadata，再轉成 JPG 並覆蓋
+        # （EXIF 與像素都來自上面那一次解碼，且不需要持有寫入鎖）
+        if is_heic:
+            try:
+                if prep["exif"]:
+                    with timed("geocode"):
+                        date_str, country, city = extract_exif_fields(prep["exif"])
                 else:
-                    metadata = []
+                    print(f"❌ No EXIF found: {image_path}")
 
-                # 讀使用者的 index
-                if os.path.exists(user_index):
-                    index = faiss.read_index(user_index)
-                else:
-                    dim = embedder.get_sentence_embedding_dimension()
-                    index = faiss.IndexFlatL2(dim)
-
-                # 更新 metadata
-                # 預設欄位
-                country = None
-                city = None
-                date_str = None
-
-                # 若為 HEIC，先提取 metadata，再轉成 JPG 並覆蓋
-                if image_path.lower().endswith(".heic"):
-                    try:
-                        img = Image.open(full_path)
-
-                        # 提取 EXIF
-                        exif_bytes = img.info.get("exif")
-                        if exif_bytes:
-                            exif_dict = piexif.load(exif_bytes)
-
-                            # 時間
-                            date_bytes = exif_dict.get("Exif", {}).get(piexif.ExifIFD.DateTimeOriginal)
-                            if date_bytes:
-                                date_str = date_bytes.decode(errors="ignore").split(" ")[0].replace(":", "-")
-
-                            # GPS
-                            gps = exif_dict.get("GPS", {})
-                            lat = gps.get(piexif.GPSIFD.GPSLatitude)
-                            lat_ref = gps.get(piexif.GPSIFD.GPSLatitudeRef)
-                            lon = gps.get(piexif.GPSIFD.GPSLongitude)
-                            lon_ref = gps.get(piexif.GPSIFD.GPSLongitudeRef)
-
-                            if lat and lat_ref and lon and lon_ref:
-                                lat_decimal = dms_to_decimal(lat, lat_ref)
-                                lon_decimal = dms_to_decimal(lon, lon_ref)
-                                location = geolocator.reverse((lat_decimal, lon_decimal), language="en", timeout=10)
-                                if location and "address" in location.raw:
-                                    addr = location.raw["address"]
-                                    country = addr.get("country")
-                                    city = addr.get("city", addr.get("town", addr.get("village")))
-                        else:
-                            print(f"❌ No EXIF found: {image_path}")
-
-                        # ✅ 轉成 JPG 並覆蓋：uploads/foo.heic → uploads/foo.jpg
-                        base_name = os.path.splitext(image_path)[0]  # uploads/foo
-                        new_rel_path = base_name + ".jpg"
-                        new_abs_path = os.path.join("/data", new_rel_path)
-
-                        img.convert("RGB").save(new_abs_path, "JPEG")
-
-                        # 刪除原始 .heic
-                        os.remove(full_path)
-
-                        # 保存舊的.heic路徑用於移除
-                        orig_heic_path = orig_image_path  # 暫存原始.heic路徑
-                        
-                        # 替換 image_path 與 full_path 為新的 .jpg
-                        image_path = new_rel_path
-                        full_path = new_abs_path
-                        
-                        # --- HEIC ➜ JPG 成功後同步更新所有Redis keys ---
-                        # 0. 準備新舊key
-                        old_key = f"{user}:{orig_heic_path}"
-                        new_key = f"{user}:{new_rel_path}"
-                        
-                        # 1. 移除舊 processing 標記
-                        redis.delete(f"processing_ts:{user}:{orig_heic_path}")
-                        redis.srem(f"{PROCESSING_SET_PREFIX}:{user}", orig_heic_path)
-                        redis.hdel("processing_workers", old_key)
-                        
-                        # 2. 加入新 processing 標記
-                        redis.set(f"processing_ts:{user}:{new_rel_path}", time.time())
-                        redis.sadd(f"{PROCESSING_SET_PREFIX}:{user}", new_rel_path)
-                        redis.hset("processing_workers", new_key, WORKER_NAME)
-                        
-                        # 3. 更新變數，讓後面清理 / done_set 都用 .jpg
-                        orig_image_path = new_rel_path  # 後續 finally/清理用
-                        
-                        # 4. done_set處理
-                        redis.sadd(f"{DONE_SET_PREFIX}:{user}", new_rel_path)
-                        redis.srem(f"{DONE_SET_PREFIX}:{user}", orig_heic_path)
-                        
-                        print(f"🖼️ HEIC converted and replaced: {image_path}")
-
-                    except Exception as e:
-                        print(f"⚠️ HEIC metadata or convert failed: {e}")
-
-                # 這裡添加移動過來的向量生成代碼
-                full_text = f"{caption}. Location: {city}, {country}. Date: {date_str or ''}."
-                vec = embedder.encode(full_text).astype(np.float32)
-
-                entry = {
-                    "filename": image_path,
-                    "caption": caption
-                }
-                if country:
-                    entry["country"] = country
-                if city:
-                    entry["city"] = city
-                if date_str:
-                    entry["date"] = date_str
-
-                metadata.append(entry)
-                json.dump(metadata, open(user_meta, "w", encoding="utf-8"), ensure_ascii=False, indent=2)
-
-                # 更新 FAISS
-                index.add(np.array([vec]))
-                faiss.write_index(index, user_index)
-
-            # 處理完成：移除 processing 記錄、加入 done 並清 processing_workers
-            redis.delete(f"processing_ts:{user}:{orig_image_path}")
-            redis.srem(f"{PROCESSING_SET_PREFIX}:{user}", orig_image_path)
-            redis.hdel("processing_workers", f"{user}:{orig_image_path}")
-            redis.sadd(f"{DONE_SET_PREFIX}:{user}", orig_image_path)
-
-            elapsed = time.time() - start_time
-            print(f"✅ {WORKER_NAME} done {image_path} for user {user} in {elapsed:.2f}s: {caption}")
+                # ✅ 轉成 JPG 並覆蓋：uploads/foo.heic → uploads/foo.jpg
+                base_name = os.path.splitext(image_path)[0]  # uploads/foo
+                new_rel_path = base_name + ".jpg"
+                new_abs_path = os.path.join(root, new_rel_path)
+
+                with timed("heic_convert"):
+                    image.save(new_abs_path, "JPEG", quality=92)
+
+                # 刪除原始 .heic
+                os.remove(full_path)
+
+                # 保存舊的.heic路徑用於移除
+                orig_heic_path = orig_image_path  # 暫存原始.heic路徑
+
+                # 替換 image_path 與 full_path 為新的 .jpg
+                image_path = new_rel_path
+                full_path = new_abs_path
+
+                # --- HEIC ➜ JPG 成功後同步更新所有Redis keys ---
+                # 1. 移除舊 processing 標記與租約
+                clear_processing(user, orig_heic_path)
+
+                # 2. 加入新 processing 標記與租約
+                mark_processing(user, new_rel_path, lane=lane)
 
+                # 3. 更新變數，讓後面清理 / done_set 都用 .jpg
+                orig_image_path = new_rel_path  # 後續 finally/清理用
+
+                # 4. done_set處理
+                redis.sadd(f"{DONE_SET_PREFIX}:{user}", new_rel_path)
+                redis.srem(f"{DONE_SET_PREFIX}:{user}", orig_heic_path)
+
+                publish_event("heic_converted", user=user, item=new_rel_path, source=orig_heic_path, worker=WORKER_NAME)
+                print(f"🖼️ HEIC converted and replaced: {image_path}")
+
+            except Exception as e:
+                print(f"⚠️ HEIC metadata or convert failed: {e}")
+
+        # 向量在取得鎖之前先算好，縮短持有鎖的時間
+        entry = {
+            "filename": image_path,
+            "caption": caption
+        }
+        if country:
+            entry["country"] = country
+        if city:
+            entry["city"] = city
+        if date_str:
+            entry["date"] = date_str
+
+        def embed(params):
+            with timed("embed"):
+                return encode_text(embedding_text(entry), params)
+
+        # 產生縮圖 / 預覽圖（不需持有寫入鎖）：在寫入索引之前完成，
+        # 否則搜尋結果先出現，controller 會同時補產生同一個檔案
+        try:
+            with timed("derivatives"):
+                make_derivatives(image, root, image_path)
         except Exception as e:
-            # 處理失敗：清處理時間，記錄 error，並做一次 retry
-            error_msg = f"❌ Error processing {image_path} for user {user} by {WORKER_NAME}: {str(e)}"
-            print(error_msg)
-            print(traceback.format_exc())
+            print(f"⚠️ Derivative generation failed for {image_path}: {e}")
+
+        # 加鎖寫 metadata 和 FAISS
+        write_snapshot_entry(user, "image", "write_lock", entry, embed)
 
-            # 清理 processing set
-            redis.delete(f"processing_ts:{user}:{orig_image_path}")
-            redis.srem(f"{PROCESSING_SET_PREFIX}:{user}", orig_image_path)
-            redis.set(f"error:{user}:{orig_image_path}", error_msg)
+        # 處理完成：移除 processing 記錄與租約、加入 done
+        clear_processing(user, orig_image_path)
+        redis.sadd(f"{DONE_SET_PREFIX}:{user}", orig_image_path)
 
-            # 重試一次
-            if not redis.get(f"retry:{user}:{orig_image_path}"):
-                print(f"🔄 Requeueing {image_path} for user {user} for retry")
-                redis.set(f"retry:{user}:{orig_image_path}", "1")
-                redis.lpush(f"{QUEUE_PREFIX}:{user}", image_path)
-            else:
-                print(f"❌ Failed to process {image_path} for user {user} after retry")
+        elapsed = time.time() - start_time
+        processed_count += 1
+        inc_counter("images_processed_total", worker=WORKER_NAME, kind="image")
+        observe("task_seconds", elapsed, kind="image", service=SERVICE_NAME)
+        publish_event("task_done", user=user, item=orig_image_path, worker=WORKER_NAME, kind="image",
+                      seconds=round(elapsed, 3))
+        print(f"✅ {WORKER_NAME} done {image_path} for user {user} in {elapsed:.2f}s: {caption}")
 
     except Exception as e:
-        print(f"⚠️ Worker main loop error: {str(e)}")
+        # 處理失敗：清處理時間，記錄 error，並做一次 retry
+        error_msg = f"❌ Error processing {image_path} for user {user} by {WORKER_NAME}: {str(e)}"
+        print(error_msg)
         print(traceback.format_exc())
-        time.sleep(5)
\ No newline at end of file
+
+        # 清理 processing 記錄與租約
+        clear_processing(user, orig_image_path)
+        redis.set(f"error:{user}:{orig_image_path}", error_msg)
+        inc_counter("task_errors_total", worker=WORKER_NAME)
+        publish_event("task_error", user=user, item=orig_image_path, worker=WORKER_NAME, error=str(e))
+
+        # 重試一次
+        if not redis.get(f"retry:{user}:{orig_image_path}"):
+            print(f"🔄 Requeueing {image_path} for user {user} for retry")
+            redis.set(f"retry:{user}:{orig_image_path}", "1")
+            redis.hset(f"enqueue_ts:{user}", image_path, time.time())
+            redis.lpush(queue_key(user, lane), image_path)
+            publish_event("task_retry", user=user, item=image_path, worker=WORKER_NAME)
+        else:
+            print(f"❌ Failed to process {image_path} for user {user} after retry")
+
+
+def run_loop():
+    # 載入 metadata 和 index
+    # 不需要預先載入全域metadata和index
+    print(f"Worker '{WORKER_NAME}' started on {device} device")
+
+    # 不停循環從 redis 的 image_queue 拿任務出來做
+    while True:
+        try:
+            task = claim_task()
+            # 如果沒有任何任務，sleep 然後繼續
+            if task is None:
+                time.sleep(0.1)
+                continue
+            process_task(*task)
+
+        except Exception as e:
+            print(f"⚠️ Worker main loop error: {str(e)}")
+            print(traceback.format_exc())
+            time.sleep(5)
+
+# ===== Pre-fork：supervisor 只載入一次模型，fork 出的子行程以 copy-on-write 共用權重 =====
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", "1"))
+# 每個子行程的 torch intra-op thread 數，預設平分 CPU，避免 N 個行程互搶核心
+TORCH_THREADS = int(os.getenv("TORCH_THREADS", "0")) or max(1, (os.cpu_count() or 1) // max(WORKER_PROCESSES, 1))
+RESTART_BACKOFF_MAX = 30
+# 子行程存活超過這個秒數才算正常執行過，重啟的退避時間歸零
+STABLE_SECONDS = 60
+
+def set_worker_name(name):
+    global WORKER_NAME, SERVICE_NAME, HEARTBEAT_KEY
+    WORKER_NAME = SERVICE_NAME = name
+    HEARTBEAT_KEY = f"heartbeat:{name}"
+
+def release_worker_tasks(name):
+    """子行程崩潰後會以同一個名稱重啟，心跳不會斷；手上任務的租約直接設為到期，交給 controller 回收"""
+    key = f"{WORKER_TASKS_PREFIX}:{name}"
+    members = redis.smembers(key)
+    if members:
+        redis.zadd(LEASE_ZSET, {m: 0 for m in members}, xx=True)
+    redis.delete(key)
+    return members
+
+def run_child(name):
+    """fork 出來的子行程：換成自己的名稱與 Redis 連線後照常註冊、跑任務迴圈"""
+    global redis
+    set_worker_name(name)
+    redis = Redis(host=REDIS_HOST, port=6379, decode_responses=True)
+    context.configure(redis, SERVICE_NAME)
+    # 不同子行程的 random 狀態都複製自 parent，要重新 seed，否則挑任務的順序全部相同
+    random.seed()
+    torch.set_num_threads(TORCH_THREADS)
+
+    def stop(signum, frame):
+        on_exit()
+        os._exit(0)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    register_worker()
+    run_loop()
+
+def supervise():
+    """
+    載入模型後 fork WORKER_PROCESSES 個子行程（名稱為 {WORKER_NAME}-1 ... -N），
+    子行程結束就重啟；收到 SIGTERM / SIGINT 時轉送給所有子行程後結束
+    """
+    if WORKER_PROCESSES <= 1:
+        load_models()
+        register_worker()
+        run_loop()
+        return
+
+    # parent 不做推論，載入時只用單一 thread，fork 之前不啟動 OpenMP thread pool
+    torch.set_num_threads(1)
+    load_models()
+    if device == "cuda":
+        # CUDA context 無法跨 fork 使用
+        print("⚠️ WORKER_PROCESSES > 1 is not supported on CUDA, running a single worker")
+        register_worker()
+        run_loop()
+        return
+
+    # 把目前所有物件移到 permanent generation，子行程的 GC 不會掃描寫入這些 page，減少 copy-on-write
+    gc.freeze()
+
+    names = {slot: f"{WORKER_NAME}-{slot}" for slot in range(1, WORKER_PROCESSES + 1)}
+    children = {}   # pid -> slot
+    started = {}    # slot -> 啟動時間
+    failures = {slot: 0 for slot in names}
+    stopping = False
+
+    def spawn(slot):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                run_child(names[slot])
+            finally:
+                os._exit(1)
+        children[pid] = slot
+        started[slot] = time.time()
+        print(f"🚀 Started {names[slot]} (pid {pid}, {TORCH_THREADS} torch threads)")
+
+    def shutdown(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    print(f"Supervisor '{WORKER_NAME}' loaded models on {device}, forking {WORKER_PROCESSES} workers")
+    for slot in names:
+        spawn(slot)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        slot = children.pop(pid, None)
+        if slot is None or stopping:
+            continue
+
+        name = names[slot]
+        code = os.waitstatus_to_exitcode(status)
+        print(f"💀 {name} (pid {pid}) exited with {code}, restarting")
+        try:
+            released = release_worker_tasks(name)
+            publish_event("worker_restart", worker=name, exit_code=code, released=len(released))
+        except Exception as e:
+            print(f"⚠️ Failed to release tasks of {name}: {e}")
+
+        # 連續崩潰時指數退避，避免啟動即崩潰時不停 fork
+        failures[slot] = 0 if time.time() - started[slot] > STABLE_SECONDS else failures[slot] + 1
+        time.sleep(min(RESTART_BACKOFF_MAX, 2 ** failures[slot] - 1))
+        if not stopping:
+            spawn(slot)
+
+if __name__ == "__main__":
+    supervise()